@@ -1,102 +1,2643 @@
 import os
 import sys
+import io
+import collections
+import math
+import time
+import datetime
+import contextlib
+import dataclasses
+import json
+import queue
+import codecs
+import shutil
+import fnmatch
+import functools
+import hashlib
+import signal
+import socket
+import threading
 import argparse
-from PIL import Image
-import docx2txt
-from pdf2image import convert_from_path
-
-def convert_image(input_path, output_path, output_format):
-    try:
-        img = Image.open(input_path)
-        img.save(output_path, output_format)
-        print(f"Изображение '{input_path}' успешно сконвертировано в '{output_path}'")
-    except Exception as e:
-        print(f"Ошибка при конвертации изображения '{input_path}': {e}")
-def convert_text(input_path, output_path, output_format):
-    try:
-        with open(input_path, 'r', encoding='utf-8') as f: # Улучшена обработка кодировки
-            text = f.read()
-        with open(output_path, 'w', encoding='utf-8') as f: # Улучшена обработка кодировки
-            f.write(text)
-        print(f"Текстовый файл '{input_path}' успешно сконвертирован в '{output_path}'")
-    except Exception as e:
-        print(f"Ошибка при конвертации текстового файла '{input_path}': {e}")
-def convert_docx(input_path, output_path):
-    try:
-        text = docx2txt.process(input_path)
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(text)
-        print(f"Документ docx '{input_path}' успешно сконвертирован в '{output_path}'")
-    except Exception as e:
-        print(f"Ошибка при конвертации документа docx '{input_path}': {e}")
-def convert_pdf_to_image(input_path, output_dir):
-    try:
-        pages = convert_from_path(input_path)
-        for i, page in enumerate(pages):
-            output_path = os.path.join(output_dir, f"page_{i+1}.jpg")
-            page.save(output_path, "JPEG")
-            print(f"Страница {i+1} из PDF '{input_path}' сохранена в '{output_path}'")
-    except Exception as e:
-        print(f"Ошибка при конвертации PDF '{input_path}': {e}")
-def batch_convert(input_dir, output_dir, input_format, output_format):
+import concurrent.futures
+# Тяжелые библиотеки кодеков (PIL, pdf2image), разбор docx, HTTP-стек и модули бенчмарка импортируются
+# внутри функций при первом использовании, чтобы --help, конвертация txt и клиент submit не платили за их загрузку
+
+@contextlib.contextmanager
+def _timed(stats, stage):
+    """Добавляет длительность блока к stats['stages'][stage]; при stats=None ничего не делает."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stages = stats.setdefault('stages', {})
+            stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - started
+
+def _downscale_image(img, max_size):
+    """Уменьшает только что открытое изображение так, чтобы большая сторона была не больше max_size."""
+    if max_size and max(img.size) > max_size:
+        # thumbnail до загрузки пикселей: для JPEG включает draft-режим (декодирование сразу
+        # в 1/2..1/8 масштаба в DCT-области), затем уменьшает через reduce() и ресэмплинг
+        from PIL import Image
+        img.thumbnail((max_size, max_size), Image.LANCZOS, reducing_gap=2.0)
+    return img
+
+# Размер блока (в символах) для потокового перекодирования текста
+TEXT_CHUNK_SIZE = 1024 * 1024
+# Допустимые значения нормализации переводов строк
+NEWLINES = {'lf': '\n', 'crlf': '\r\n', 'cr': '\r'}
+
+def _detect_encoding(input_path, sample_size=64 * 1024):
+    """Определяет кодировку по началу файла: BOM, затем проверка UTF-8, затем chardet (если установлен)."""
+    with open(input_path, 'rb') as f:
+        return _detect_encoding_bytes(f.read(sample_size))
+
+def _detect_encoding_bytes(sample):
+    """Определяет кодировку по образцу байтов (см. _detect_encoding)."""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # final=False: многобайтовый символ мог оборваться на границе выборки
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    try:
+        import chardet
+    except ImportError:
+        return 'utf-8'
+    return chardet.detect(sample)['encoding'] or 'utf-8'
+
+def _pil_format(output_format, output_path=None):
+    """Имя формата для Pillow: из output_format или расширения output_path; 'jpg' -> 'JPEG'."""
+    fmt = (output_format or os.path.splitext(output_path or '')[1].lstrip('.')).upper()
+    if not fmt:
+        raise ValueError("Не указан выходной формат изображения")
+    return {'JPG': 'JPEG', 'TIF': 'TIFF'}.get(fmt, fmt)
+
+# Профили кодирования изображений: формат Pillow -> параметры save(). Профили меняют только
+# скорость и степень сжатия без потерь; качество JPEG/WebP задается явно (encoder_options)
+ENCODER_PROFILES = {
+    'fast': {'PNG': {'compress_level': 1, 'optimize': False},
+             'JPEG': {'optimize': False, 'progressive': False, 'subsampling': 2},
+             'WEBP': {'method': 0}},
+    'balanced': {'PNG': {'compress_level': 4, 'optimize': False},
+                 'JPEG': {'optimize': True, 'progressive': False, 'subsampling': 2},
+                 'WEBP': {'method': 3}},
+    'smallest': {'PNG': {'compress_level': 9, 'optimize': True},
+                 'JPEG': {'optimize': True, 'progressive': True, 'subsampling': 2},
+                 'WEBP': {'method': 6}},
+}
+
+def _encoder_options(output_format, encoder_profile=None, encoder_options=None):
+    """Параметры Image.save() для формата Pillow: профиль ENCODER_PROFILES, поверх него encoder_options.
+
+    Без профиля и явных параметров — умолчания Pillow.
+    """
+    if encoder_profile is not None and encoder_profile not in ENCODER_PROFILES:
+        raise ValueError(f"Неизвестный профиль кодирования: '{encoder_profile}' "
+                         f"(доступны: {', '.join(ENCODER_PROFILES)})")
+    options = dict(ENCODER_PROFILES[encoder_profile].get(output_format, {})) if encoder_profile else {}
+    options.update(encoder_options or {})
+    return options
+
+def parse_encoder_option(value):
+    """Разбирает параметр кодировщика 'КЛЮЧ=ЗНАЧЕНИЕ'; числа и true/false приводятся к своим типам."""
+    key, sep, raw = value.partition('=')
+    if not sep or not key.strip():
+        raise ValueError(f"Ожидается КЛЮЧ=ЗНАЧЕНИЕ: '{value}'")
+    raw = raw.strip()
+    if raw.lower() in ('true', 'false'):
+        return key.strip(), raw.lower() == 'true'
+    for cast in (int, float):
+        try:
+            return key.strip(), cast(raw)
+        except ValueError:
+            pass
+    return key.strip(), raw
+
+# Путь '-' означает stdin (для входа) или stdout (для выхода)
+STDIO = '-'
+# Сколько первых байтов нужно _sniff_format (заголовок BMP с размером DIB-заголовка — 18 байтов)
+SNIFF_BYTES = 18
+# Сигнатуры форматов: (смещение, байты, входной формат)
+_MAGIC_NUMBERS = (
+    (0, b'\xff\xd8\xff', 'jpg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'GIF87a', 'gif'),
+    (0, b'GIF89a', 'gif'),
+    (0, b'II*\x00', 'tiff'),
+    (0, b'MM\x00*', 'tiff'),
+    (8, b'WEBP', 'webp'),
+    (0, b'%PDF-', 'pdf'),
+    (0, b'PK\x03\x04', 'docx'), # Из ZIP-контейнеров поддерживается только docx
+)
+# Синонимы расширений: _sniff_format возвращает основное имя формата
+_FORMAT_ALIASES = {'jpeg': 'jpg', 'tif': 'tiff'}
+
+def _same_format(first, second):
+    """True, если два имени формата (расширения) обозначают один формат с учетом _FORMAT_ALIASES."""
+    return _FORMAT_ALIASES.get(first, first) == _FORMAT_ALIASES.get(second, second)
+
+# Допустимые размеры DIB-заголовка BMP (BITMAPCOREHEADER ... BITMAPV5HEADER)
+_BMP_DIB_SIZES = (12, 40, 52, 56, 64, 108, 124)
+
+def _is_bmp_header(header, size=None):
+    """Проверяет заголовок BMP целиком: двухбайтовой сигнатуры 'BM' мало (с нее начинается и обычный текст),
+    поэтому зарезервированные байты должны быть нулевыми, размер DIB-заголовка — допустимым,
+    а поле размера файла — совпадать с size, если он известен."""
+    if len(header) < 18 or header[:2] != b'BM' or header[6:10] != b'\x00\x00\x00\x00':
+        return False
+    if int.from_bytes(header[14:18], 'little') not in _BMP_DIB_SIZES:
+        return False
+    return size is None or int.from_bytes(header[2:6], 'little') == size
+
+def _sniff_format(header, size=None):
+    """Входной формат по первым байтам (SNIFF_BYTES): сигнатура из _MAGIC_NUMBERS или заголовок BMP
+    (size — полный размер данных, если известен), иначе 'txt' для данных без нулевых байтов
+    (или с BOM UTF-16/32); None — формат не распознан."""
+    for offset, magic, input_format in _MAGIC_NUMBERS:
+        if header[offset:offset + len(magic)] == magic:
+            return input_format
+    if _is_bmp_header(header, size):
+        return 'bmp'
+    return _sniff_text(header)
+
+def _sniff_text(header):
+    """'txt', если первые байты похожи на текст (нет нулевых байтов или есть BOM UTF-16/32), иначе None."""
+    if header.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)) or b'\x00' not in header:
+        return 'txt'
+    return None
+
+# Сколько байтов stdin нужно Pillow, чтобы открыть заголовок BMP (с палитрой)
+BMP_HEADER_BYTES = 4096
+
+class _PrefixedReader(io.RawIOBase):
+    """Сырой поток, который сначала отдает prefix, а затем остаток stream: возвращает
+    в stdin байты, дочитанные _peek_stdin."""
+
+    def __init__(self, prefix, stdin):
+        self._prefix = prefix
+        self._stdin = stdin # Прежний sys.stdin: иначе при сборке мусора он закроет свой буфер
+        self._stream = stdin.buffer
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._prefix[:len(buffer)] if self._prefix else self._stream.read1(len(buffer))
+        self._prefix = self._prefix[len(data):]
+        buffer[:len(data)] = data
+        return len(data)
+
+def _peek_stdin(size=SNIFF_BYTES):
+    """Первые size байтов stdin (меньше — только если данные кончились) без их извлечения из потока.
+
+    Одно чтение из канала может вернуть лишь часть байтов, поэтому они дочитываются до size,
+    а sys.stdin подменяется потоком, который отдает их заново (_PrefixedReader).
+    """
+    stream = sys.stdin.buffer
+    prefix = stream.peek(size)[:size]
+    if len(prefix) == size:
+        return prefix
+    prefix = b''
+    while len(prefix) < size and (chunk := stream.read1(size - len(prefix))):
+        prefix += chunk
+    sys.stdin = io.TextIOWrapper(io.BufferedReader(_PrefixedReader(prefix, sys.stdin)))
+    return prefix
+
+def _sniff_stdin():
+    """Формат данных stdin по _sniff_format. Размер потока неизвестен, поэтому заголовок BMP
+    дополнительно проверяется Pillow по первым BMP_HEADER_BYTES байтам; если он не открывается, данные
+    считаются текстом (если похожи на него)."""
+    header = _peek_stdin()
+    input_format = _sniff_format(header)
+    if input_format == 'bmp':
+        from PIL import Image
+        try:
+            Image.open(io.BytesIO(_peek_stdin(BMP_HEADER_BYTES))).close() # Читается только заголовок
+        except Exception:
+            return _sniff_text(header)
+    return input_format
+
+def _message_stream(*paths):
+    """Куда печатать сообщения о конвертации: в stderr, если stdout занят данными (или вход — stdin)."""
+    return sys.stderr if STDIO in paths else sys.stdout
+
+# Сколько байтов с конца файла читает _probe_file для поиска маркера конца
+PROBE_TAIL_BYTES = 64 * 1024
+# Маркеры конца файла формата. Обычно маркер в последних PROBE_TAIL_BYTES; если его там нет,
+# файл мог получить большой хвост (например, видео «живого фото» после EOI JPEG), и решает полная проверка
+_END_MARKERS = {'jpg': (b'\xff\xd9', 'нет маркера конца JPEG (EOI)'),
+                'png': (b'IEND', 'нет блока IEND'),
+                'gif': (b'\x3b', 'нет завершающего байта GIF'),
+                'pdf': (b'%%EOF', 'нет маркера %%EOF')}
+# Форматы, у которых маркер — последний байт файла (допускается только дополнение нулями):
+# одиночный байт 0x3b в хвосте GIF встречается и внутри сжатых данных
+_FINAL_MARKERS = ('gif',)
+
+def _probe_file(path, input_format=None):
+    """Быстрая проверка файла перед конвертацией без декодирования;
+    возвращает (формат, причина отказа, заголовок изображения).
+
+    Формат определяется по сигнатуре (_sniff_format) независимо от расширения; если сигнатура
+    не распознана или похожа на текст, используется input_format (формат по расширению).
+    Заголовок BMP проверяется только по полям, поэтому если такой файл не открывается как BMP,
+    а расширение говорит о другом формате, проверяется формат по расширению.
+    Затем проверяется только заголовок и конец файла (см. _check_file). Причина — None, если файл можно конвертировать;
+    заголовок изображения (см. _image_header) позволяет оценить память задания без повторного
+    открытия файла (_header_memory), для остальных файлов он None.
+    """
+    try:
+        with open(path, 'rb') as f:
+            sniffed = _sniff_format(f.read(SNIFF_BYTES), os.fstat(f.fileno()).st_size)
+    except OSError as e:
+        return input_format, f"не удалось прочитать заголовок: {e}", None
+    if sniffed in (None, 'txt') or _same_format(sniffed, input_format):
+        return (input_format, *_check_file(path, input_format))
+    reason, header = _check_file(path, sniffed)
+    if reason is not None and sniffed == 'bmp' and input_format is not None:
+        return (input_format, *_check_file(path, input_format))
+    return sniffed, reason, header
+
+def _check_file(path, input_format):
+    """Проверка заголовка и конца файла формата input_format; возвращает (причина отказа или None,
+    заголовок изображения или None).
+
+    Изображения открываются Image.open без load(), у docx читается центральный каталог ZIP,
+    а у JPEG, PNG и PDF в последних PROBE_TAIL_BYTES ищется маркер конца (_END_MARKERS); у GIF
+    завершающий байт должен быть последним (_FINAL_MARKERS). Только если маркера в конце нет,
+    файл проверяется целиком (_has_valid_body): данные после маркера допустимы, обрезанный файл — нет.
+    """
+    header = None
+    try:
+        if input_format in ImageConverter.input_formats or input_format == 'webp':
+            from PIL import Image
+            with Image.open(path) as img: # Читает только заголовок
+                header = _image_header(img)
+                if not img.width or not img.height:
+                    return f"нулевой размер изображения {img.size}", header
+        elif input_format == 'docx':
+            import zipfile
+            with zipfile.ZipFile(path) as archive:
+                if 'word/document.xml' not in archive.namelist():
+                    return "ZIP-архив не является документом docx (нет word/document.xml)", None
+        marker_format = _FORMAT_ALIASES.get(input_format, input_format)
+        if marker_format in _END_MARKERS:
+            with open(path, 'rb') as f:
+                f.seek(max(os.fstat(f.fileno()).st_size - PROBE_TAIL_BYTES, 0))
+                tail = f.read()
+            marker, reason = _END_MARKERS[marker_format]
+            if marker_format in _FINAL_MARKERS:
+                found = tail.rstrip(b'\x00').endswith(marker)
+            else:
+                found = marker in tail
+            if not found and not _has_valid_body(path, marker_format, marker):
+                return f"файл обрезан: {reason}", header
+    except Exception as e: # В том числе PIL.UnidentifiedImageError и zipfile.BadZipFile
+        return f"не удалось прочитать заголовок: {e}", header
+    return None, header
+
+def _has_valid_body(path, marker_format, marker):
+    """Полная проверка файла без маркера конца в хвосте: изображение декодируется целиком
+    (обрезанное Pillow не загрузит), в PDF маркер ищется по всему файлу блоками."""
+    if marker_format == 'pdf':
+        with open(path, 'rb') as f:
+            previous = b''
+            while block := f.read(1024 * 1024):
+                if marker in previous[-len(marker):] + block:
+                    return True
+                previous = block
+        return False
+    from PIL import Image
+    try:
+        with Image.open(path) as img:
+            img.load()
+    except Exception:
+        return False
+    return True
+
+# Сколько страниц PDF рендерится за один вызов pdftoppm: ограничивает пиковую память
+PDF_CHUNK_PAGES = 10
+
+# Форматы страниц pdf2img: имя -> (fmt для pdftoppm или None, если кодирует Pillow; расширение файла)
+PDF_PAGE_FORMATS = {'jpeg': ('jpeg', 'jpg'), 'jpg': ('jpeg', 'jpg'), 'png': ('png', 'png'),
+                    'tiff': ('tiff', 'tiff'), 'tif': ('tiff', 'tiff'), 'webp': (None, 'webp')}
+
+def _pdf_page_format(output_format):
+    """(fmt для pdftoppm или None, расширение) по имени формата; по умолчанию JPEG."""
+    try:
+        return PDF_PAGE_FORMATS[(output_format or 'jpeg').lower().lstrip('.')]
+    except KeyError:
+        raise ValueError(f"Неподдерживаемый формат страниц PDF: '{output_format}' "
+                         f"(доступны: {', '.join(sorted(PDF_PAGE_FORMATS))})")
+
+def _render_pdf_pages(input_path, output_dir, first_page, last_page, dpi, output_format=None, quality=None,
+                      grayscale=False):
+    """Рендерит страницы first_page..last_page в output_dir как page_<N>.<ext>; возвращает [(номер, путь)].
+
+    PNG, JPEG и TIFF pdftoppm пишет сразу в выходной формат (output_folder, fmt, paths_only),
+    без промежуточного PPM и повторного кодирования в Pillow; файлы только переименовываются.
+    WebP pdftoppm не поддерживает, поэтому такие страницы кодирует Pillow.
+    """
+    from pdf2image import convert_from_path
+    fmt, ext = _pdf_page_format(output_format)
+    saved = []
+    if fmt is not None:
+        import uuid
+        prefix = f".render_{uuid.uuid4().hex}" # Уникален для окна: pdf2image ищет результаты по префиксу
+        jpegopt = {'quality': quality} if fmt == 'jpeg' and quality else None
+        paths = convert_from_path(input_path, dpi=dpi, first_page=first_page, last_page=last_page,
+                                  output_folder=output_dir, output_file=prefix, fmt=fmt, jpegopt=jpegopt,
+                                  grayscale=grayscale, paths_only=True)
+        for number, path in enumerate(sorted(paths), start=first_page):
+            output_path = os.path.join(output_dir, f"page_{number}.{ext}")
+            _break_hardlink(output_path)
+            os.replace(path, output_path)
+            saved.append((number, output_path))
+        return saved
+    pages = convert_from_path(input_path, dpi=dpi, first_page=first_page, last_page=last_page, grayscale=grayscale)
+    for number, page in enumerate(pages, start=first_page):
+        output_path = os.path.join(output_dir, f"page_{number}.{ext}")
+        _break_hardlink(output_path)
+        page.save(output_path, _pil_format(ext), **({'quality': quality} if quality else {}))
+        page.close()
+        saved.append((number, output_path))
+    return saved
+
+# --- Оценка памяти заданий ---
+MEMORY_OVERHEAD = 2 # Декодированные пиксели плюс копия при ресэмплинге или буфер кодировщика
+# Байт на пиксель во внутреннем представлении Pillow; многоканальные режимы хранятся по 4 байта
+_PIL_MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I;16N': 2}
+DOCX_STREAM_MEMORY = 4 * 1024 * 1024 # Потоковый разбор docx (см. _docx_extract_text)
+PDF_DEFAULT_PAGE_SIZE = (612.0, 792.0) # Letter в пунктах, если pdfinfo не сообщил размер страницы
+
+def _default_memory_budget():
+    """Половина физической памяти в байтах; None, если ее объем не удается узнать."""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    except (AttributeError, ValueError, OSError): # Windows или неизвестная система
+        return None
+
+def _image_header(img):
+    """Поля заголовка открытого изображения, от которых зависит оценка памяти: (размер, режим, формат)."""
+    return img.size, img.mode, img.format
+
+def _image_memory(input_path, max_size=None):
+    """Оценка пиковой памяти на конвертацию изображения по его заголовку (пиксели не декодируются)."""
+    from PIL import Image
+    with Image.open(input_path) as img:
+        return _header_memory(_image_header(img), max_size)
+
+def _header_memory(header, max_size=None):
+    """Оценка пиковой памяти по заголовку изображения (см. _image_header)."""
+    (width, height), mode, image_format = header
+    if max_size and image_format == 'JPEG':
+        # draft-режим декодирует сразу в масштабе 1/2..1/8, оставляя запас reducing_gap=2
+        scale = 1
+        while scale < 8 and max(width, height) / (scale * 2) >= max_size * 2:
+            scale *= 2
+        width, height = -(-width // scale), -(-height // scale)
+    return width * height * _PIL_MODE_BYTES.get(mode, 4) * MEMORY_OVERHEAD
+
+def _pdf_page_memory(info, dpi):
+    """Оценка памяти на одну страницу при рендеринге с разрешением dpi; info — словарь pdfinfo."""
+    try:
+        # 'Page size': '612 x 792 pts (letter)'
+        width, _, height = info['Page size'].split()[:3]
+        width, height = float(width), float(height)
+    except (KeyError, ValueError):
+        width, height = PDF_DEFAULT_PAGE_SIZE
+    return int(width / 72 * dpi) * int(height / 72 * dpi) * 4 * MEMORY_OVERHEAD
+
+def _estimate_job_memory(input_path, input_format, options=None):
+    """Оценка пиковой памяти задания пакета в байтах; 0, если заголовок не читается
+    (ошибку тогда сообщит сам конвертер)."""
+    try:
+        if input_format in TextConverter.input_formats:
+            return TEXT_CHUNK_SIZE * 8 # Блок символов (до 4 байт на символ) и его закодированная копия
+        if input_format in DocxConverter.input_formats:
+            return DOCX_STREAM_MEMORY
+        return _image_memory(input_path, (options or {}).get('max_size'))
+    except Exception:
+        return 0
+
+# Элементы WordprocessingML (в нотации expat с namespace_separator=' '), из которых складывается текст docx
+_DOCX_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main '
+_DOCX_TEXT = _DOCX_NS + 't'
+_DOCX_CONTROLS = {_DOCX_NS + 'p': '\n\n', _DOCX_NS + 'tab': '\t', _DOCX_NS + 'br': '\n', _DOCX_NS + 'cr': '\n'}
+DOCX_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def _docx_extract_text(source, write, images_dir=None):
+    """Потоково извлекает текст docx (путь или файловый объект) и передает его частями в write.
+
+    XML читается прямо из архива SAX-парсером expat: дерево документа не строится, поэтому
+    память не зависит от размера файла. Текст совпадает с docx2txt.process: верхние колонтитулы,
+    основной текст, нижние колонтитулы; абзацы отделены пустой строкой, w:tab — табуляция,
+    w:br/w:cr — перевод строки, пробелы в начале и конце убраны. Изображения из архива
+    сохраняются в images_dir, только если он задан.
+    """
+    import zipfile
+    from xml.parsers import expat
+    pending = None # Пробелы после последнего записанного текста; None — текст еще не начался
+    chunks = None # Части текущего w:t
+
+    def start(name, attrs):
+        nonlocal chunks, pending
+        if name == _DOCX_TEXT:
+            chunks = []
+        elif pending is not None:
+            pending += _DOCX_CONTROLS.get(name, '')
+
+    def end(name):
+        nonlocal chunks, pending
+        if name != _DOCX_TEXT:
+            return
+        text = ''.join(chunks)
+        chunks = None
+        if pending is None:
+            text = text.lstrip()
+            if not text:
+                return
+            pending = ''
+        body = text.rstrip()
+        if body:
+            write(pending + body)
+            pending = text[len(body):]
+        else:
+            pending += text
+
+    def data(text):
+        if chunks is not None:
+            chunks.append(text)
+
+    with zipfile.ZipFile(source) as zf:
+        names = zf.namelist()
+        parts = ([name for name in names if fnmatch.fnmatch(name, 'word/header*.xml')] + ['word/document.xml'] +
+                 [name for name in names if fnmatch.fnmatch(name, 'word/footer*.xml')])
+        for part in parts:
+            parser = expat.ParserCreate(namespace_separator=' ')
+            parser.buffer_text = True
+            parser.StartElementHandler = start
+            parser.EndElementHandler = end
+            parser.CharacterDataHandler = data
+            with zf.open(part) as f:
+                parser.ParseFile(f)
+        if images_dir is not None:
+            os.makedirs(images_dir, exist_ok=True)
+            for name in names:
+                if os.path.splitext(name)[1].lower() in DOCX_IMAGE_EXTENSIONS:
+                    with zf.open(name) as src, open(os.path.join(images_dir, os.path.basename(name)), 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+
+# --- Библиотечный API: реестр конвертеров ---
+class ConversionError(Exception):
+    """Ошибка конвертации; возбуждается ConversionResult.raise_for_error()."""
+
+@dataclasses.dataclass
+class ConversionResult:
+    """Результат конвертации одного входного файла."""
+    input_path: str
+    output_paths: list = dataclasses.field(default_factory=list)
+    ok: bool = False
+    bytes_in: int = 0
+    bytes_out: int = 0
+    stages: dict = dataclasses.field(default_factory=dict) # Секунды по стадиям (open/decode/encode/write)
+    error: str = None
+    cached: bool = False # Результат взят из ConversionCache без конвертации
+
+    @property
+    def seconds(self):
+        return sum(self.stages.values())
+
+    def raise_for_error(self):
+        """Возбуждает ConversionError для неуспешного результата, иначе возвращает сам результат."""
+        if not self.ok:
+            raise ConversionError(f"'{self.input_path}': {self.error}")
+        return self
+
+class Converter:
+    """Базовый конвертер. Экземпляр не хранит состояния отдельного файла, поэтому один объект
+    из реестра переиспользуется для любого числа конвертаций в долгоживущем процессе.
+
+    Подклассы задают name, input_formats, options (допустимые именованные параметры),
+    шаблоны сообщений и реализуют _convert; transcode — конвертация в памяти, если поддерживается.
+    output_is_dir — output_path является директорией для нескольких файлов; cache_ignored_options —
+    параметры, не влияющие на результат (не входят в ключ ConversionCache).
+    """
+    name = None
+    input_formats = ()
+    options = ()
+    output_is_dir = False
+    cache_ignored_options = ()
+    success_message = "Файл '{input}' успешно сконвертирован в '{output}'"
+    error_message = "Ошибка при конвертации файла '{input}': {error}"
+
+    def warm_up(self):
+        """Заранее загружает кодеки, чтобы за это не платила первая конвертация."""
+
+    def convert(self, input_path, output_path, output_format=None, cache=None, **options):
+        """Конвертирует файл и возвращает ConversionResult; исключения не выходят наружу.
+
+        cache — ConversionCache: при попадании выходные файлы берутся из кэша без конвертации,
+        при промахе результат конвертации сохраняется в кэш. Если input_path или output_path —
+        STDIO ('-'), конвертация идет в памяти через transcode (см. _convert_stdio), без кэша.
+        """
+        if STDIO in (input_path, output_path):
+            return self._convert_stdio(input_path, output_path, output_format, **options)
+        result = ConversionResult(input_path)
+        stats = {}
+        try:
+            key = None
+            if cache is not None:
+                with _timed(stats, 'hash'):
+                    key = cache.key(_file_sha256(input_path), self, output_format or os.path.splitext(output_path)[1],
+                                    options)
+                with _timed(stats, 'cache'):
+                    result.output_paths = cache.get(key, output_path, self.output_is_dir)
+                result.cached = result.output_paths is not None
+            if result.cached:
+                self._cached(result.output_paths, **options)
+            else:
+                if not self.output_is_dir:
+                    _break_hardlink(output_path)
+                result.output_paths = self._convert(input_path, output_path, output_format, stats, **options)
+                if key is not None:
+                    with _timed(stats, 'cache'):
+                        cache.put(key, result.output_paths)
+            result.bytes_in = os.path.getsize(input_path)
+            result.bytes_out = sum(os.path.getsize(path) for path in result.output_paths)
+            result.ok = True
+        except Exception as e:
+            result.error = str(e)
+        result.stages = stats.get('stages', {})
+        return result
+
+    def transcode(self, data, output_format=None, **options):
+        """Конвертирует байты в памяти; возвращает (байты результата, {стадия: секунды})."""
+        raise NotImplementedError
+
+    def _convert_stdio(self, input_path, output_path, output_format, **options):
+        """convert для STDIO: вход читается целиком (stdin или файл), результат transcode пишется
+        в stdout или файл. Формат по умолчанию — расширение output_path, для stdout его нужно задать."""
+        result = ConversionResult(input_path)
+        stats = {}
+        try:
+            if type(self).transcode is Converter.transcode:
+                raise ValueError(f"Конвертер '{self.name}' не поддерживает stdin/stdout")
+            if output_format is None and output_path != STDIO:
+                output_format = os.path.splitext(output_path)[1].lstrip('.') or None
+            with _timed(stats, 'read'):
+                data = sys.stdin.buffer.read() if input_path == STDIO else _read_bytes(input_path)[0]
+            output, stages = self.transcode(data, output_format, **options)
+            with _timed(stats, 'write'):
+                if output_path == STDIO:
+                    sys.stdout.buffer.write(output)
+                    sys.stdout.buffer.flush()
+                else:
+                    _write_bytes(output_path, output)
+            stats.setdefault('stages', {}).update(stages)
+            result.output_paths = [output_path]
+            result.bytes_in, result.bytes_out = len(data), len(output)
+            result.ok = True
+        except Exception as e:
+            result.error = str(e)
+        result.stages = stats.get('stages', {})
+        return result
+
+    def _convert(self, input_path, output_path, output_format, stats, **options):
+        """Выполняет конвертацию и возвращает список созданных файлов; stats передается в _timed."""
+        raise NotImplementedError
+
+    def _cached(self, output_paths, **options):
+        """Вызывается вместо _convert, когда результат восстановлен из кэша."""
+
+    def report(self, result, file=None):
+        """Печатает сообщение об успехе или ошибке в привычном для CLI виде (в file, по умолчанию в stdout)."""
+        if not result.ok:
+            print(self.error_message.format(input=result.input_path, error=result.error), file=file)
+        elif self.success_message:
+            for output_path in result.output_paths:
+                print(self.success_message.format(input=result.input_path, output=output_path), file=file)
+
+class ImageConverter(Converter):
+    name = 'image'
+    input_formats = ('jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff')
+    options = ('max_size', 'encoder_profile', 'encoder_options')
+    success_message = "Изображение '{input}' успешно сконвертировано в '{output}'"
+    error_message = "Ошибка при конвертации изображения '{input}': {error}"
+
+    def warm_up(self):
+        from PIL import Image
+        Image.init() # Регистрирует все плагины форматов Pillow
+
+    def _convert(self, input_path, output_path, output_format, stats, max_size=None, encoder_profile=None,
+                 encoder_options=None):
+        from PIL import Image
+        output_format = _pil_format(output_format, output_path)
+        save_options = _encoder_options(output_format, encoder_profile, encoder_options)
+        with _timed(stats, 'open'):
+            img = Image.open(input_path)
+        data = self._decode_encode(img, output_format, max_size, stats, save_options)
+        with _timed(stats, 'write'):
+            with open(output_path, 'wb') as f:
+                f.write(data)
+        return [output_path]
+
+    def transcode(self, data, output_format=None, max_size=None, encoder_profile=None, encoder_options=None):
+        from PIL import Image
+        stats = {}
+        output_format = _pil_format(output_format)
+        save_options = _encoder_options(output_format, encoder_profile, encoder_options)
+        data = self._decode_encode(Image.open(io.BytesIO(data)), output_format, max_size, stats, save_options)
+        return data, stats['stages']
+
+    def fan_out(self, input_path, renditions):
+        """Декодирует изображение один раз и сохраняет из него все renditions; возвращает ConversionResult.
+
+        renditions — список словарей {'output': путь, 'format': формат (по умолчанию по расширению),
+        'max_size': большая сторона в пикселях (по умолчанию без уменьшения), 'profile' и 'options' —
+        профиль и параметры кодировщика (см. _encoder_options)}. Источник декодируется
+        сразу в масштабе самой большой копии (draft для JPEG), а уменьшения идут цепочкой от большей
+        копии к меньшей, так что каждая следующая ресэмплируется из предыдущей, а не из оригинала.
+        """
+        result = ConversionResult(input_path)
+        stats = {}
+        try:
+            result.output_paths = self._fan_out(input_path, renditions, stats)
+            result.bytes_in = os.path.getsize(input_path)
+            result.bytes_out = sum(os.path.getsize(path) for path in result.output_paths)
+            result.ok = True
+        except Exception as e:
+            result.error = str(e)
+        result.stages = stats.get('stages', {})
+        return result
+
+    def _fan_out(self, input_path, renditions, stats):
+        from PIL import Image
+        if not renditions:
+            raise ValueError("Не задано ни одного выходного варианта")
+        renditions = sorted(renditions, key=lambda rendition: -(rendition.get('max_size') or math.inf))
+        with _timed(stats, 'open'):
+            img = Image.open(input_path)
+        with _timed(stats, 'decode'):
+            img = _downscale_image(img, renditions[0].get('max_size'))
+            img.load()
+        output_paths = []
+        for rendition in renditions:
+            output_path = rendition['output']
+            max_size = rendition.get('max_size')
+            if max_size and max(img.size) > max_size:
+                with _timed(stats, 'resize'):
+                    scale = max_size / max(img.size)
+                    size = (max(round(img.width * scale), 1), max(round(img.height * scale), 1))
+                    img = img.resize(size, Image.LANCZOS, reducing_gap=2.0)
+            output_format = _pil_format(rendition.get('format'), output_path)
+            rendered = img
+            if output_format == 'JPEG' and img.mode not in ('RGB', 'L', 'CMYK'):
+                rendered = img.convert('RGB') # Прозрачность в JPEG не сохраняется
+            with _timed(stats, 'encode'):
+                buffer = io.BytesIO()
+                rendered.save(buffer, output_format,
+                              **_encoder_options(output_format, rendition.get('profile'), rendition.get('options')))
+            with _timed(stats, 'write'):
+                os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+                _break_hardlink(output_path)
+                with open(output_path, 'wb') as f:
+                    f.write(buffer.getbuffer())
+            output_paths.append(output_path)
+        return output_paths
+
+    def _decode_encode(self, img, output_format, max_size, stats, save_options=None):
+        with _timed(stats, 'decode'):
+            img = _downscale_image(img, max_size)
+            img.load()
+        with _timed(stats, 'encode'):
+            buffer = io.BytesIO()
+            img.save(buffer, output_format, **(save_options or {}))
+        return buffer.getvalue()
+
+class TextConverter(Converter):
+    name = 'text'
+    input_formats = ('txt',)
+    options = ('encoding', 'target_encoding', 'newline')
+    success_message = "Текстовый файл '{input}' успешно сконвертирован в '{output}'"
+    error_message = "Ошибка при конвертации текстового файла '{input}': {error}"
+
+    def _convert(self, input_path, output_path, output_format, stats, encoding='utf-8', target_encoding='utf-8',
+                 newline=None):
+        if encoding == 'auto':
+            with _timed(stats, 'open'):
+                encoding = _detect_encoding(input_path)
+        with _timed(stats, 'write'):
+            if newline is None and codecs.lookup(encoding).name == codecs.lookup(target_encoding).name:
+                shutil.copyfile(input_path, output_path)
+            else:
+                # newline=None при чтении сводит все переводы строк к '\n', при записи они заменяются на нужные
+                read_newline = None if newline else ''
+                write_newline = NEWLINES[newline] if newline else ''
+                with open(input_path, 'r', encoding=encoding, newline=read_newline) as src, \
+                        open(output_path, 'w', encoding=target_encoding, newline=write_newline) as dst:
+                    shutil.copyfileobj(src, dst, TEXT_CHUNK_SIZE)
+        return [output_path]
+
+    def transcode(self, data, output_format=None, encoding='utf-8', target_encoding='utf-8', newline=None):
+        if encoding == 'auto':
+            encoding = _detect_encoding_bytes(data[:64 * 1024])
+        if newline is None and codecs.lookup(encoding).name == codecs.lookup(target_encoding).name:
+            return data, {}
+        stats = {}
+        with _timed(stats, 'encode'):
+            with io.TextIOWrapper(io.BytesIO(data), encoding=encoding, newline=None if newline else '') as src:
+                text = src.read()
+            if newline:
+                text = text.replace('\n', NEWLINES[newline])
+            data = text.encode(target_encoding)
+        return data, stats['stages']
+
+class DocxConverter(Converter):
+    """Извлекает текст docx потоково (см. _docx_extract_text); images_dir включает сохранение изображений."""
+    name = 'docx'
+    input_formats = ('docx',)
+    options = ('images_dir',)
+    success_message = "Документ docx '{input}' успешно сконвертирован в '{output}'"
+    error_message = "Ошибка при конвертации документа docx '{input}': {error}"
+
+    def _convert(self, input_path, output_path, output_format, stats, images_dir=None):
+        # Разбор и запись чередуются, поэтому время считается одной стадией decode. Текст пишется
+        # во временный файл, чтобы при ошибке на середине документа не оставить обрезанный результат
+        tmp_path = output_path + '.part'
+        with _timed(stats, 'decode'):
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    _docx_extract_text(input_path, f.write, images_dir)
+                os.replace(tmp_path, output_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return [output_path]
+
+    def transcode(self, data, output_format=None, images_dir=None):
+        stats = {}
+        with _timed(stats, 'decode'):
+            text = io.StringIO()
+            _docx_extract_text(io.BytesIO(data), text.write, images_dir)
+        return text.getvalue().encode('utf-8'), stats['stages']
+
+class PdfConverter(Converter):
+    """Конвертер PDF в изображения страниц; output_path — выходная директория."""
+    name = 'pdf'
+    input_formats = ('pdf',)
+    options = ('first_page', 'last_page', 'dpi', 'chunk_size', 'workers', 'on_page', 'memory_budget', 'quality',
+               'grayscale')
+    output_is_dir = True
+    cache_ignored_options = ('chunk_size', 'workers', 'on_page', 'memory_budget')
+    success_message = None # Страницы сообщаются через on_page по мере готовности
+    error_message = "Ошибка при конвертации PDF '{input}': {error}"
+
+    def _convert(self, input_path, output_dir, output_format, stats, first_page=None, last_page=None, dpi=200,
+                 chunk_size=PDF_CHUNK_PAGES, workers=1, on_page=None, memory_budget=None, quality=None,
+                 grayscale=False):
+        """Страницы рендерятся окнами по chunk_size штук, поэтому в памяти одновременно не больше
+        одного окна на процесс. При workers > 1 окна распределяются между процессами.
+        on_page(номер, путь) вызывается для каждой сохраненной страницы.
+
+        output_format — формат страниц (PDF_PAGE_FORMATS, по умолчанию JPEG), quality — качество
+        JPEG/WebP, grayscale — рендеринг в оттенках серого (см. _render_pdf_pages).
+
+        memory_budget (байты) ограничивает суммарную оценку памяти окон в работе: размер страницы
+        при данном dpi берется из pdfinfo, окно уменьшается вплоть до одной страницы, а окна
+        запускаются параллельно, только пока помещаются в бюджет."""
+        from pdf2image import pdfinfo_from_path
+        fmt, _ = _pdf_page_format(output_format)
+        os.makedirs(output_dir, exist_ok=True)
+        info = pdfinfo_from_path(input_path)
+        page_count = info['Pages']
+        first_page = max(first_page or 1, 1)
+        last_page = min(last_page or page_count, page_count)
+        if first_page > last_page:
+            raise ValueError(f"Пустой диапазон страниц {first_page}-{last_page} (всего страниц: {page_count})")
+        chunk_size = max(chunk_size, 1)
+        page_memory = _pdf_page_memory(info, dpi)
+        if fmt is not None:
+            # pdftoppm сам кодирует страницы по одной: окно держит в памяти только текущую страницу
+            window_cost = lambda window: page_memory
+        else:
+            if memory_budget:
+                chunk_size = max(min(chunk_size, memory_budget // page_memory), 1)
+            window_cost = lambda window: (window[3] - window[2] + 1) * page_memory
+        windows = ((input_path, output_dir, start, min(start + chunk_size - 1, last_page), dpi, output_format,
+                    quality, grayscale)
+                   for start in range(first_page, last_page + 1, chunk_size))
+        pages = {}
+        with _timed(stats, 'render'):
+            for _, saved, error in _run_jobs(_render_pdf_pages, windows, workers, max_in_flight=workers,
+                                             job_cost=window_cost, memory_budget=memory_budget):
+                if error is not None:
+                    raise error
+                for number, output_path in saved:
+                    pages[number] = output_path
+                    if on_page is not None:
+                        on_page(number, output_path)
+        return [pages[number] for number in sorted(pages)]
+
+    def _cached(self, output_paths, on_page=None, **options):
+        if on_page is not None:
+            for output_path in output_paths: # page_<N>.<ext>
+                on_page(int(os.path.splitext(os.path.basename(output_path))[0].rsplit('_', 1)[1]), output_path)
+
+_CONVERTERS = {}
+
+def register_converter(converter):
+    """Регистрирует экземпляр конвертера под его именем и всеми входными форматами."""
+    _CONVERTERS[converter.name] = converter
+    for fmt in converter.input_formats:
+        _CONVERTERS[fmt] = converter
+    return converter
+
+def get_converter(name_or_format):
+    """Конвертер по имени ('image', 'text', 'docx', 'pdf') или входному расширению; None, если такого нет."""
+    return _CONVERTERS.get(name_or_format.lower().lstrip('.'))
+
+def warm_up_converters():
+    """Прогревает все зарегистрированные конвертеры (например, в инициализаторе пула процессов)."""
+    for converter in set(_CONVERTERS.values()):
+        converter.warm_up()
+
+def convert_file(input_path, output_path, output_format=None, input_format=None, **options):
+    """Конвертирует файл конвертером, выбранным по input_format или расширению input_path.
+
+    Возвращает ConversionResult и ничего не печатает, поэтому подходит для встраивания в сервисы.
+    """
+    input_format = input_format or os.path.splitext(input_path)[1]
+    converter = get_converter(input_format) if input_format else None
+    if converter is None:
+        return ConversionResult(input_path, error=f"Неподдерживаемый входной формат: '{input_format}'")
+    return converter.convert(input_path, output_path, output_format, **options)
+
+register_converter(ImageConverter())
+register_converter(TextConverter())
+register_converter(DocxConverter())
+register_converter(PdfConverter())
+
+def _fill_stats(stats, result):
+    """Переносит стадии и ошибку из ConversionResult в словарь stats старых функций convert_*."""
+    if stats is not None:
+        stats.setdefault('stages', {}).update(result.stages)
+        if result.error is not None:
+            stats['error'] = result.error
+
+def convert_image(input_path, output_path, output_format, max_size=None, stats=None, cache=None,
+                  encoder_profile=None, encoder_options=None):
+    """Конвертирует изображение; при max_size уменьшает его так, чтобы большая сторона была не больше max_size.
+
+    Если передан словарь stats, в stats['stages'] записывается время стадий open/decode/encode/write,
+    а при ошибке — stats['error']. cache — ConversionCache для повторяющихся файлов.
+    encoder_profile ('fast', 'balanced', 'smallest') и encoder_options (например, {'quality': 85})
+    задают параметры кодировщика (см. ENCODER_PROFILES). input_path и output_path могут быть STDIO ('-'):
+    тогда изображение читается из stdin или пишется в stdout, а сообщения печатаются в stderr.
+    """
+    converter = get_converter('image')
+    result = converter.convert(input_path, output_path, output_format, cache=cache, max_size=max_size,
+                               encoder_profile=encoder_profile, encoder_options=encoder_options)
+    converter.report(result, file=_message_stream(input_path, output_path))
+    _fill_stats(stats, result)
+    return result.ok
+def convert_text(input_path, output_path, output_format, encoding='utf-8', target_encoding='utf-8', newline=None,
+                 stats=None, cache=None):
+    """Копирует текстовый файл, при необходимости перекодируя его и нормализуя переводы строк.
+
+    encoding='auto' включает определение исходной кодировки. newline — 'lf', 'crlf', 'cr'
+    или None (оставить как есть). Если перекодировать нечего, файл копируется байтами
+    (shutil.copyfile использует sendfile), иначе обрабатывается блоками по TEXT_CHUNK_SIZE
+    символов, так что память не зависит от размера файла. stats — как в convert_image
+    (чтение, перекодирование и запись идут одним потоком и учитываются как стадия write).
+    Пути могут быть STDIO ('-'), как в convert_image.
+    """
+    converter = get_converter('text')
+    result = converter.convert(input_path, output_path, output_format, cache=cache, encoding=encoding,
+                               target_encoding=target_encoding, newline=newline)
+    converter.report(result, file=_message_stream(input_path, output_path))
+    _fill_stats(stats, result)
+    return result.ok
+def convert_docx(input_path, output_path, stats=None, cache=None, images_dir=None):
+    """Извлекает текст docx в output_path потоково, не загружая документ целиком.
+
+    Изображения из документа сохраняются в images_dir, только если он задан. Пути могут быть
+    STDIO ('-'), как в convert_image (docx из stdin читается в память целиком: ZIP требует произвольного доступа).
+    """
+    converter = get_converter('docx')
+    result = converter.convert(input_path, output_path, cache=cache, images_dir=images_dir)
+    converter.report(result, file=_message_stream(input_path, output_path))
+    _fill_stats(stats, result)
+    return result.ok
+def convert_pdf_to_image(input_path, output_dir, first_page=None, last_page=None, dpi=200,
+                         chunk_size=PDF_CHUNK_PAGES, workers=1, cache=None, memory_budget=None, output_format='jpeg',
+                         quality=None, grayscale=False):
+    """Сохраняет страницы PDF в output_dir как page_<N>.<ext> в формате output_format
+    (jpeg, png, tiff, webp; см. PdfConverter)."""
+    def on_page(number, output_path):
+        print(f"Страница {number} из PDF '{input_path}' сохранена в '{output_path}'")
+    converter = get_converter('pdf')
+    result = converter.convert(input_path, output_dir, output_format, cache=cache, first_page=first_page,
+                               last_page=last_page, dpi=dpi, chunk_size=chunk_size, workers=workers, on_page=on_page,
+                               memory_budget=memory_budget, quality=quality, grayscale=grayscale)
+    converter.report(result)
+    return result.ok
+# Входные форматы, которые умеет обрабатывать пакетная конвертация (один вход — один выходной файл)
+BATCH_INPUT_FORMATS = ImageConverter.input_formats + TextConverter.input_formats + DocxConverter.input_formats
+# Выходные форматы, которые дают только конвертеры документов (текст) и только конвертер изображений
+_DOCUMENT_OUTPUT_FORMATS = ('txt', 'docx', 'pdf')
+_IMAGE_OUTPUT_FORMATS = ImageConverter.input_formats + ('webp',)
+
+def _routing_error(content_format, output_format):
+    """Причина отказа, если файл, направленный по содержимому в конвертер формата content_format,
+    нельзя сконвертировать в output_format (выбранный по расширению), иначе None. Например, PNG
+    под именем .txt при выходном формате 'txt' иначе записал бы картинку в файл .txt."""
+    output_format = _FORMAT_ALIASES.get(output_format.lower(), output_format.lower())
+    image_content = content_format in ImageConverter.input_formats
+    if image_content and output_format in _DOCUMENT_OUTPUT_FORMATS or \
+            not image_content and output_format in _IMAGE_OUTPUT_FORMATS:
+        return f"содержимое в формате '{content_format}' нельзя сконвертировать в '{output_format}'"
+    return None
+
+def _converter_options(converter, options):
+    """Оставляет из options только параметры, которые понимает converter."""
+    return {key: value for key, value in (options or {}).items() if key in converter.options}
+
+def _convert_job(input_path, output_path, input_format, output_format, options=None, cache=None, report=True):
+    """Конвертирует один файл пакета. Вызывается и в дочерних процессах пула, поэтому функция верхнего уровня.
+
+    options — словарь дополнительных параметров конвертации (например, max_size для изображений).
+    report=False отключает сообщение о результате (его печатает вызывающий код).
+    Возвращает статистику файла: ok, stages (секунды по стадиям), bytes_in, bytes_out, error и cached.
+    """
+    converter = get_converter(input_format)
+    if converter is None:
+        result = ConversionResult(input_path, error=f"Неподдерживаемый входной формат: '{input_format}'")
+    else:
+        result = converter.convert(input_path, output_path, output_format, cache=cache,
+                                   **_converter_options(converter, options))
+        if report:
+            converter.report(result)
+    return dataclasses.asdict(result)
+
+def _run_jobs(func, jobs, workers=1, max_in_flight=None, monitor=None, job_cost=None, memory_budget=None):
+    """Вызывает func(*job) для каждого задания и отдает тройки (задание, результат, исключение).
+
+    При workers > 1 задания уходят в пул процессов (func должна быть функцией верхнего уровня),
+    но одновременно в работе держится не больше max_in_flight задач, поэтому генератор jobs
+    не вычитывается целиком заранее. Выдача идет в порядке завершения заданий.
+    monitor(глубина), если задан, вызывается при каждой постановке задания в пул.
+
+    При memory_budget (байты) задание попадает в пул, только если сумма оценок job_cost(job)
+    заданий в работе вместе с ним не превышает бюджет; задание дороже всего бюджета
+    дожидается, пока пул опустеет, и выполняется в одиночку.
+    """
+    if workers <= 1:
+        for job in jobs:
+            try:
+                yield job, func(*job), None
+            except Exception as e:
+                yield job, None, e
+        return
+    if max_in_flight is None:
+        max_in_flight = workers * 2
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=warm_up_converters) as pool:
+        in_flight = {}
+        costs = {}
+        def drain():
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = in_flight.pop(future)
+                costs.pop(future)
+                try:
+                    yield job, future.result(), None
+                except Exception as e: # В том числе упавший дочерний процесс
+                    yield job, None, e
+        for job in jobs:
+            cost = job_cost(job) if memory_budget else 0
+            while in_flight and (len(in_flight) >= max_in_flight or
+                                 memory_budget and sum(costs.values()) + cost > memory_budget):
+                yield from drain()
+            future = pool.submit(func, *job)
+            in_flight[future] = job
+            costs[future] = cost
+            if monitor is not None:
+                monitor(len(in_flight))
+        while in_flight:
+            yield from drain()
+
+# Потоков предварительной проверки (_probe_file) в batch_convert и насколько заданий они опережают конвертацию
+PROBE_THREADS = 4
+PROBE_LOOKAHEAD = 64
+
+def _run_ahead(func, items, threads=PROBE_THREADS, lookahead=PROBE_LOOKAHEAD):
+    """Отдает пары (элемент, func(элемент)) в исходном порядке, вычисляя func в пуле потоков.
+
+    items вычитываются лениво: func выполняется не больше чем на lookahead элементов вперед
+    потребителя, поэтому легкие проверки идут параллельно и заранее, не накапливая весь поток.
+    """
+    with concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='probe') as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= lookahead:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+def _read_bytes(path):
+    """Стадия чтения конвейера: файл целиком в память; возвращает (данные, секунды)."""
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        return f.read(), time.perf_counter() - started
+
+def _write_bytes(path, data):
+    """Стадия записи конвейера; возвращает длительность в секундах."""
+    started = time.perf_counter()
+    _break_hardlink(path)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return time.perf_counter() - started
+
+def _transcode_bytes(data, input_format, output_format, options=None):
+    """Стадия кодеков конвейера: декодирует входные байты и возвращает (байты результата, {стадия: секунды}).
+
+    Использует Converter.transcode того же конвертера, что и _convert_job, но без файлового
+    ввода-вывода, поэтому ее можно выполнять в пуле процессов, пока потоки чтения и записи
+    заняты диском или сетью.
+    """
+    converter = get_converter(input_format)
+    if converter is None:
+        raise ValueError(f"Неподдерживаемый входной формат: '{input_format}'")
+    return converter.transcode(data, output_format, **_converter_options(converter, options))
+
+# Форматы, которые конвейер не читает в память целиком: их конвертеры работают потоково
+# (TextConverter блоками, DocxConverter разбором ZIP), и память не зависит от размера файла
+PIPELINE_STREAMED_FORMATS = TextConverter.input_formats + DocxConverter.input_formats
+
+def _run_pipeline(jobs, workers=1, io_threads=4, max_in_flight=None, monitor=None, cache=None, job_cost=None,
+                  memory_budget=None):
+    """Конвейер чтение -> кодеки -> запись для заданий пакета; отдает (задание, статистика, исключение).
+
+    Чтение и запись выполняются в двух пулах по io_threads потоков, декодирование и
+    кодирование — в пуле из workers процессов (или в одном потоке при workers <= 1).
+    Стадии работают одновременно, а общее число файлов в конвейере ограничено
+    max_in_flight, поэтому очереди между стадиями и потребление памяти ограничены.
+    Статистика и monitor — как у _convert_job и _run_jobs. С cache (ConversionCache) ключ
+    считается по уже прочитанным байтам, и при попадании файл не доходит до стадии кодеков.
+    Файлы PIPELINE_STREAMED_FORMATS не проходят стадии чтения и записи: их целиком, от файла
+    до файла, конвертирует _convert_job в пуле кодеков, чтобы не терять потоковую обработку.
+    job_cost и memory_budget ограничивают суммарную оценку памяти файлов в конвейере (см. _run_jobs).
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * (workers + io_threads)
+    results = queue.Queue()
+
+    def then(future, job, next_step):
+        # Передает результат стадии следующей; при ошибке файл сразу выходит из конвейера
+        try:
+            next_step(future.result())
+        except Exception as e:
+            results.put((job, None, e))
+
+    if workers > 1:
+        cpu_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=warm_up_converters)
+    else:
+        cpu_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    with concurrent.futures.ThreadPoolExecutor(io_threads, thread_name_prefix='reader') as readers, \
+            concurrent.futures.ThreadPoolExecutor(io_threads, thread_name_prefix='writer') as writers, cpu_pool:
+        def start(job):
+            input_path, output_path, input_format, output_format, options = job
+            def streamed(job_stats):
+                if not job_stats['ok']: # Ошибка конвертера выходит из конвейера так же, как ошибка стадии
+                    raise ConversionError(job_stats['error'])
+                results.put((job, job_stats, None))
+            if input_format in PIPELINE_STREAMED_FORMATS:
+                cpu_pool.submit(_convert_job, *job, cache=cache, report=False) \
+                    .add_done_callback(lambda f: then(f, job, streamed))
+                return
+            stats = {'ok': False, 'stages': {}, 'bytes_in': 0, 'bytes_out': 0, 'error': None, 'cached': False}
+            key = None
+            def encode(read_result):
+                nonlocal key
+                data, stats['stages']['read'] = read_result
+                stats['bytes_in'] = len(data)
+                converter = get_converter(input_format)
+                if cache is not None and converter is not None:
+                    with _timed(stats, 'hash'):
+                        key = cache.key(hashlib.sha256(data).hexdigest(), converter, output_format,
+                                        _converter_options(converter, options))
+                    with _timed(stats, 'cache'):
+                        restored = cache.get(key, output_path)
+                    if restored is not None:
+                        stats['bytes_out'] = os.path.getsize(output_path)
+                        stats['ok'] = stats['cached'] = True
+                        results.put((job, stats, None))
+                        return
+                cpu_pool.submit(_transcode_bytes, data, input_format, output_format, options) \
+                    .add_done_callback(lambda f: then(f, job, write))
+            def write(transcode_result):
+                data, stages = transcode_result
+                stats['stages'].update(stages)
+                stats['bytes_out'] = len(data)
+                writers.submit(_write_bytes, output_path, data) \
+                    .add_done_callback(lambda f: then(f, job, done))
+            def done(write_seconds):
+                stats['stages']['write'] = write_seconds
+                if key is not None:
+                    with _timed(stats, 'cache'):
+                        cache.put(key, [output_path])
+                stats['ok'] = True
+                results.put((job, stats, None))
+            readers.submit(_read_bytes, input_path).add_done_callback(lambda f: then(f, job, encode))
+
+        in_flight = 0
+        costs = {} # id(задание) -> оценка памяти
+        for job in jobs:
+            cost = job_cost(job) if memory_budget else 0
+            while in_flight and (in_flight >= max_in_flight or
+                                 memory_budget and sum(costs.values()) + cost > memory_budget):
+                finished = results.get()
+                costs.pop(id(finished[0]))
+                in_flight -= 1
+                yield finished
+            costs[id(job)] = cost
+            start(job)
+            in_flight += 1
+            if monitor is not None:
+                monitor(in_flight)
+        while in_flight:
+            yield results.get()
+            in_flight -= 1
+
+# Манифест инкрементального режима: JSON-lines в выходной директории, по записи на входной файл
+MANIFEST_NAME = '.converter_manifest.jsonl'
+
+def _file_sha256(path, chunk_size=1024 * 1024):
+    """SHA-256 содержимого файла, читается блоками фиксированного размера."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_manifest(manifest_path):
+    """Читает манифест в словарь {относительный путь входа: запись}; поздние записи перекрывают ранние."""
+    records = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError: # Обрезанная строка после аварийного завершения
+                    continue
+                records[record['input']] = record
+    return records
+
+def _save_manifest(manifest_path, records):
+    """Атомарно перезаписывает манифест, оставляя по одной записи на файл."""
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in records.values():
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, manifest_path)
+
+def _is_up_to_date(record, stat, input_path, output_path, params):
+    """Проверяет по записи манифеста, что файл уже сконвертирован с теми же параметрами."""
+    if record is None or record.get('params') != params or not os.path.exists(output_path):
+        return False
+    if record['size'] != stat.st_size:
+        return False
+    if record['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    # mtime изменился (например, файл скопировали заново) — сверяем содержимое
+    if _file_sha256(input_path) == record['sha256']:
+        record['mtime_ns'] = stat.st_mtime_ns
+        return True
+    return False
+
+# --- Кэш результатов конвертации ---
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+CACHE_VERSION = 1 # Меняется, если меняется результат конвертеров при тех же параметрах
+CACHE_LOW_WATER = 0.9 # Вытеснение освобождает место до этой доли бюджета, чтобы не запускаться на каждой записи
+
+def _break_hardlink(path):
+    """Удаляет файл перед перезаписью, если у него есть жесткие ссылки (например, на запись кэша),
+    чтобы запись на месте не испортила общие данные."""
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# ioctl FICLONE (Linux): reflink — новый файл разделяет блоки исходного с копированием при записи
+FICLONE = 0x40049409
+
+def _clone_file(source, target):
+    """Создает target с содержимым source, по возможности без копирования данных.
+
+    Сначала пробует reflink (FICLONE; Btrfs, XFS и др.), затем жесткую ссылку, затем обычную копию.
+    target заменяется атомарно. Возвращает способ: 'reflink', 'link' или 'copy'.
+    """
+    part_path = target + '.part'
+    if os.path.lexists(part_path):
+        os.remove(part_path)
+    try:
+        import fcntl
+        with open(source, 'rb') as src, open(part_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        method = 'reflink'
+    except (ImportError, OSError): # Не Linux или ФС без reflink
+        if os.path.lexists(part_path):
+            os.remove(part_path)
+        try:
+            os.link(source, part_path)
+            method = 'link'
+        except OSError:
+            shutil.copyfile(source, part_path)
+            method = 'copy'
+    os.replace(part_path, target)
+    return method
+
+class ConversionCache:
+    """Контентно-адресуемый кэш результатов конвертации на диске.
+
+    Ключ — SHA-256 от содержимого входного файла, конвертера, целевого формата и параметров,
+    поэтому одинаковые файлы под разными именами конвертируются один раз. Запись хранится
+    в <root>/<ключ[:2]>/<ключ>/ и при попадании связывается с местом назначения жесткой
+    ссылкой (при link=False или на другой файловой системе — копируется). Суммарный размер
+    записей ограничен max_bytes: при превышении удаляются давно не использованные (LRU по
+    mtime записи, которое обновляется при каждом попадании).
+
+    Записи появляются атомарным переименованием готовой директории, а счетчик размера
+    и вытеснение выполняются под файловой блокировкой, поэтому один кэш можно использовать
+    из нескольких процессов пула одновременно. Объект хранит только настройки и передается
+    в дочерние процессы.
+    """
+    INDEX_NAME = 'index.json'
+    SIZE_NAME = '.size'
+    LOCK_NAME = '.lock'
+
+    def __init__(self, root, max_bytes=DEFAULT_CACHE_SIZE, link=True):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.link = link
+        os.makedirs(os.path.join(self.root, 'tmp'), exist_ok=True)
+
+    def key(self, digest, converter, output_format, options):
+        """Ключ записи по SHA-256 входа (digest), конвертеру, целевому формату и параметрам."""
+        options = {name: value for name, value in options.items()
+                   if name not in converter.cache_ignored_options and not callable(value)}
+        payload = [CACHE_VERSION, digest, converter.name, (output_format or '').lstrip('.').lower(), options]
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key, output_path, output_is_dir=False):
+        """Восстанавливает результат в output_path (файл или директорию) и возвращает список файлов;
+        None — промах."""
+        entry = self._entry_path(key)
+        try:
+            with open(os.path.join(entry, self.INDEX_NAME), encoding='utf-8') as f:
+                names = json.load(f)
+            os.utime(entry) # Отметка использования для LRU
+            if output_is_dir:
+                os.makedirs(output_path, exist_ok=True)
+                targets = [os.path.join(output_path, name) for name in names]
+            else:
+                targets = [output_path]
+            for name, target in zip(names, targets):
+                self._place(os.path.join(entry, name), target)
+        except (FileNotFoundError, ValueError): # Записи нет или ее вытеснили во время чтения
+            return None
+        return targets
+
+    def put(self, key, output_paths):
+        """Сохраняет выходные файлы под ключом; возвращает False, если запись не создана
+        (не помещается в бюджет, уже создана другим процессом или ошибка диска)."""
+        import tempfile
+        size = sum(os.path.getsize(path) for path in output_paths)
+        if size > self.max_bytes:
+            return False
+        entry = self._entry_path(key)
+        tmp = tempfile.mkdtemp(dir=os.path.join(self.root, 'tmp'))
+        try:
+            names = [os.path.basename(path) for path in output_paths]
+            for path, name in zip(output_paths, names):
+                self._place(path, os.path.join(tmp, name))
+            with open(os.path.join(tmp, self.INDEX_NAME), 'w', encoding='utf-8') as f:
+                json.dump(names, f)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            with self._locked():
+                total = self._read_size()
+                os.rename(tmp, entry)
+                total += size
+                if total > self.max_bytes:
+                    total = self._evict(int(self.max_bytes * CACHE_LOW_WATER))
+                self._write_size(total)
+        except OSError: # В том числе запись с этим ключом уже создал другой процесс
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        return True
+
+    def size(self):
+        """Текущий суммарный размер записей в байтах."""
+        with self._locked():
+            return self._read_size()
+
+    def _entry_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _place(self, source, target):
+        if self.link:
+            try:
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.link(source, target)
+                return
+            except OSError: # Другая файловая система или ФС без жестких ссылок
+                pass
+        shutil.copyfile(source, target)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        try:
+            import fcntl
+        except ImportError: # Windows: блокировки нет, кэш рассчитан на один процесс
+            fcntl = None
+        with open(os.path.join(self.root, self.LOCK_NAME), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _entries(self):
+        """Отдает (mtime, размер, путь) для каждой записи."""
+        with os.scandir(self.root) as buckets:
+            for bucket in buckets:
+                if bucket.name == 'tmp' or bucket.name.startswith('.') or not bucket.is_dir():
+                    continue
+                with os.scandir(bucket.path) as entries:
+                    for entry in entries:
+                        try:
+                            mtime = entry.stat().st_mtime
+                            with os.scandir(entry.path) as files:
+                                size = sum(item.stat().st_size for item in files if item.name != self.INDEX_NAME)
+                        except FileNotFoundError:
+                            continue
+                        yield mtime, size, entry.path
+
+    def _read_size(self):
+        try:
+            with open(os.path.join(self.root, self.SIZE_NAME), encoding='utf-8') as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError): # Счетчика еще нет или он поврежден — пересчитываем
+            return sum(size for _, size, _ in self._entries())
+
+    def _write_size(self, total):
+        tmp_path = os.path.join(self.root, self.SIZE_NAME + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(total))
+        os.replace(tmp_path, os.path.join(self.root, self.SIZE_NAME))
+
+    def _evict(self, target):
+        """Удаляет самые давно использованные записи, пока размер не станет не больше target;
+        возвращает итоговый размер."""
+        import tempfile
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            # Сначала убираем запись из пространства ключей, чтобы читатели видели промах, а не половину файлов
+            trash = tempfile.mkdtemp(dir=os.path.join(self.root, 'tmp'))
+            try:
+                os.rename(path, os.path.join(trash, 'entry'))
+            except OSError:
+                continue
+            finally:
+                shutil.rmtree(trash, ignore_errors=True)
+            total -= size
+        return total
+
+# Журнал пакета: JSON-lines в выходной директории; первая строка — параметры пакета,
+# далее записи {input, state, attempts, error} с состояниями pending/done/failed
+JOURNAL_NAME = '.converter_journal.jsonl'
+JOURNAL_SYNC_RECORDS = 256 # fsync после стольких записей...
+JOURNAL_SYNC_SECONDS = 1.0 # ...или не реже чем раз в столько секунд
+
+class BatchJournal:
+    """Долговечный журнал состояния файлов пакета для продолжения после сбоя.
+
+    Записи дописываются в конец файла и сбрасываются на диск (fsync) пачками по
+    JOURNAL_SYNC_RECORDS записей или раз в JOURNAL_SYNC_SECONDS, поэтому после аварийного
+    завершения теряется не больше последней пачки: такие файлы просто будут обработаны заново.
+    Для каждого файла действует последняя запись. При закрытии журнал атомарно сжимается
+    до одной записи на файл.
+    """
+
+    def __init__(self, path, params, resume=False):
+        self.path = path
+        self.params = params
+        self.states = {} # относительный путь -> последняя запись
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError: # Обрезанная строка после аварийного завершения
+                        continue
+                    if 'batch' in record:
+                        if record['batch'] != params:
+                            raise ValueError(f"Журнал '{path}' относится к пакету с другими параметрами; "
+                                             "запустите без --resume, чтобы начать заново")
+                    else:
+                        self.states[record['input']] = record
+            self._file = open(path, 'a', encoding='utf-8')
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+            self._file.write(json.dumps({'batch': params}, ensure_ascii=False) + '\n')
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def state(self, key):
+        """Последнее состояние файла ('pending', 'done', 'failed') или None."""
+        record = self.states.get(key)
+        return record['state'] if record else None
+
+    def attempts(self, key):
+        record = self.states.get(key)
+        return record.get('attempts', 0) if record else 0
+
+    def record(self, key, state, error=None):
+        attempts = self.attempts(key) + (state == 'failed')
+        record = {'input': key, 'state': state, 'attempts': attempts}
+        if error is not None:
+            record['error'] = str(error)
+        self.states[key] = record
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._unsynced += 1
+        if self._unsynced >= JOURNAL_SYNC_RECORDS or time.monotonic() - self._synced_at >= JOURNAL_SYNC_SECONDS:
+            self.sync()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.sync()
+        self._file.close()
+        self._file = None
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'batch': self.params}, ensure_ascii=False) + '\n')
+            for record in self.states.values():
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+class BatchMetrics:
+    """Метрики пакетной конвертации: время стадий, байты, результаты по форматам и глубина очереди пула.
+
+    Записи по файлам сразу дописываются в JSON-lines (если задан jsonl_path), сводные
+    счетчики выгружаются методом write_prometheus в текстовом формате Prometheus.
+    """
+
+    def __init__(self, jsonl_path=None):
+        self.files = collections.Counter() # (формат, ok|failed) -> число файлов
+        self.stage_seconds = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cache_hits = 0
+        self.deduplicated = 0
+        self.queue_depth_max = 0
+        self.queue_depth_sum = 0
+        self.queue_depth_samples = 0
+        self._jsonl = open(jsonl_path, 'a', encoding='utf-8') if jsonl_path else None
+
+    def sample_queue_depth(self, depth):
+        self.queue_depth_max = max(self.queue_depth_max, depth)
+        self.queue_depth_sum += depth
+        self.queue_depth_samples += 1
+
+    def record(self, job, stats, error=None):
+        """Учитывает результат одного файла; stats может быть None, если задание упало с исключением."""
+        stats = stats or {}
+        input_format = os.path.splitext(job[0])[1].lstrip('.').lower()
+        ok = error is None and stats.get('ok', False)
+        self.files[(input_format, 'ok' if ok else 'failed')] += 1
+        self.stage_seconds.update(stats.get('stages', {}))
+        self.bytes_in += stats.get('bytes_in', 0)
+        self.bytes_out += stats.get('bytes_out', 0)
+        self.cache_hits += bool(ok and stats.get('cached'))
+        self.deduplicated += bool(ok and stats.get('deduplicated'))
+        if self._jsonl is not None:
+            record = {'input': job[0], 'output': job[1], 'format': input_format, 'ok': ok,
+                      'error': str(error) if error is not None else stats.get('error'),
+                      'stages': stats.get('stages', {}), 'bytes_in': stats.get('bytes_in', 0),
+                      'bytes_out': stats.get('bytes_out', 0), 'cached': stats.get('cached', False),
+                      'deduplicated': stats.get('deduplicated', False)}
+            self._jsonl.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def close(self):
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+    def as_dict(self):
+        failed_by_format = {fmt: count for (fmt, status), count in self.files.items() if status == 'failed'}
+        return {
+            'stage_seconds': dict(self.stage_seconds),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'cache_hits': self.cache_hits,
+            'deduplicated': self.deduplicated,
+            'failed_by_format': failed_by_format,
+            'queue_depth_max': self.queue_depth_max,
+            'queue_depth_avg': self.queue_depth_sum / self.queue_depth_samples if self.queue_depth_samples else 0,
+        }
+
+    def write_prometheus(self, path):
+        """Записывает метрики в текстовом формате Prometheus (например, для node_exporter textfile)."""
+        lines = ['# HELP converter_files_total Files handled by batch_convert.',
+                 '# TYPE converter_files_total counter']
+        for (fmt, status), count in sorted(self.files.items()):
+            lines.append(f'converter_files_total{{format="{fmt}",status="{status}"}} {count}')
+        lines += ['# HELP converter_stage_seconds_total Time spent per conversion stage.',
+                  '# TYPE converter_stage_seconds_total counter']
+        for stage, seconds in sorted(self.stage_seconds.items()):
+            lines.append(f'converter_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}')
+        lines += ['# TYPE converter_bytes_in_total counter', f'converter_bytes_in_total {self.bytes_in}',
+                  '# TYPE converter_bytes_out_total counter', f'converter_bytes_out_total {self.bytes_out}',
+                  '# TYPE converter_cache_hits_total counter', f'converter_cache_hits_total {self.cache_hits}',
+                  '# TYPE converter_deduplicated_total counter', f'converter_deduplicated_total {self.deduplicated}',
+                  '# TYPE converter_queue_depth_max gauge', f'converter_queue_depth_max {self.queue_depth_max}']
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+@contextlib.contextmanager
+def _profiling(kind, output_path=None):
+    """Профилирует блок: kind — 'cprofile', 'tracemalloc' или None (без профилирования).
+
+    Отчет пишется в output_path (для cprofile — двоичный файл pstats) или в stderr.
+    Профилируется только текущий процесс, дочерние процессы пула не учитываются.
+    """
+    if kind == 'cprofile':
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output_path:
+                profiler.dump_stats(output_path)
+            else:
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+    elif kind == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report = [f"Пик выделенной памяти: {peak / (1024 * 1024):.1f} МБ"]
+            report += [str(stat) for stat in snapshot.statistics('lineno')[:25]]
+            if output_path:
+                with open(output_path, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(report) + '\n')
+            else:
+                print('\n'.join(report), file=sys.stderr)
+    else:
+        yield
+
+def _parse_format_map(input_format, output_format):
+    """Строит словарь {входное расширение: выходной формат} из строк вида 'jpg,png,docx' и 'png,png,txt'.
+
+    Один выходной формат применяется ко всем входным. Расширения приводятся к нижнему регистру.
+    """
+    inputs = [fmt.strip().lstrip('.').lower() for fmt in input_format.split(',') if fmt.strip()]
+    outputs = [fmt.strip().lstrip('.') for fmt in output_format.split(',') if fmt.strip()]
+    if len(outputs) == 1:
+        outputs = outputs * len(inputs)
+    if not inputs or len(outputs) != len(inputs):
+        raise ValueError(f"Число выходных форматов '{output_format}' не соответствует входным '{input_format}'")
+    return dict(zip(inputs, outputs))
+
+def _glob_match(rel_path, patterns):
+    """Совпадает ли относительный путь (или только имя файла) с одним из glob-шаблонов."""
+    rel_path = rel_path.replace(os.sep, '/')
+    name = rel_path.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def _scan_files(root, recursive=False, include=None, exclude=None, skip_dirs=(), onerror=None):
+    """Потоково обходит root через os.scandir и отдает (путь, относительный путь) для каждого файла.
+
+    В памяти хранится только стек еще не обойденных директорий, а не список всех файлов.
+    include/exclude — glob-шаблоны для относительного пути или имени; exclude применяется
+    и к директориям. Директории из skip_dirs (например, выходная внутри входной) пропускаются.
+    Символические ссылки на директории обходятся, но каждая директория (st_dev, st_ino) — только
+    один раз, поэтому петли вида sub/loop -> .. не зацикливают обход. Директорию, которую не удалось
+    прочитать, обход пропускает и вызывает onerror(путь, исключение), если он задан.
+    """
+    skip_dirs = {os.path.realpath(path) for path in skip_dirs}
+    visited = set()
+    pending = [root]
+    while pending:
+        current = pending.pop()
+        try:
+            stat = os.stat(current)
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    rel_path = os.path.relpath(entry.path, root)
+                    if exclude and _glob_match(rel_path, exclude):
+                        continue
+                    if entry.is_dir():
+                        if recursive and os.path.realpath(entry.path) not in skip_dirs:
+                            pending.append(entry.path)
+                    elif entry.is_file():
+                        if include and not _glob_match(rel_path, include):
+                            continue
+                        yield entry.path, rel_path
+        except OSError as e:
+            if current is root:
+                raise
+            if onerror is not None:
+                onerror(current, e)
+
+def batch_convert(input_dir, output_dir, input_format, output_format, workers=1, incremental=False, max_size=None,
+                  io_threads=0, metrics=None, recursive=False, include=None, exclude=None, cache=None,
+                  memory_budget=None, journal=False, resume=False, retry_failed=False, retries=0,
+                  retry_backoff=1.0, encoder_profile=None, encoder_options=None, dedupe=False, probe=False,
+                  probe_threads=PROBE_THREADS):
+    """Пакетная конвертация файлов из input_dir в output_dir.
+
+    input_format — одно или несколько расширений через запятую (регистр не важен), output_format —
+    один формат для всех или столько же через запятую (см. _parse_format_map). При recursive=True
+    обходятся и поддиректории, структура которых повторяется в output_dir; include/exclude —
+    списки glob-шаблонов для отбора файлов.
+
+    При incremental=True в output_dir ведется манифест (MANIFEST_NAME) с размером, mtime,
+    SHA-256 и параметрами конвертации каждого файла; неизменившиеся файлы пропускаются.
+    max_size ограничивает большую сторону выходных изображений, encoder_profile и encoder_options
+    задают параметры кодировщика изображений (см. convert_image).
+    io_threads > 0 включает конвейер (_run_pipeline): чтение и запись идут в io_threads потоках
+    независимо от workers процессов, занятых кодеками, что ускоряет работу с сетевыми дисками.
+    metrics — объект BatchMetrics для сбора метрик (по умолчанию создается новый).
+    cache — ConversionCache: файлы с уже встречавшимся содержимым не конвертируются повторно.
+    memory_budget (байты) включает контроль допуска: память каждого файла оценивается по заголовку
+    (размеры и режим изображения), и параллельно выполняются только файлы, суммарно помещающиеся
+    в бюджет; файл больше бюджета выполняется в одиночку, а не роняет весь пакет.
+
+    journal=True ведет в output_dir журнал состояний файлов (BatchJournal, JOURNAL_NAME).
+    resume=True продолжает пакет по журналу: уже сконвертированные и упавшие файлы пропускаются,
+    а прерванные (pending) и новые обрабатываются. retry_failed=True обрабатывает только файлы,
+    упавшие в прошлых запусках. Упавшие файлы повторяются до retries раз с экспоненциальной
+    паузой retry_backoff, 2*retry_backoff, ... секунд.
+
+    dedupe=True убирает повторы внутри пакета: файлы с одинаковым содержимым (SHA-256 считается
+    при обходе и только для файлов, размер которых уже встречался) и одинаковыми форматами
+    конвертируются один раз, а остальные выходные файлы создаются reflink-копией или жесткой
+    ссылкой на результат (см. _clone_file).
+
+    probe=True включает предварительную проверку (_probe_file) в probe_threads потоках впереди
+    конвертации: файл направляется в конвертер по содержимому, а не по расширению, а поврежденные
+    и обрезанные файлы сразу учитываются как упавшие с причиной и не занимают процессы конвертации.
+
+    Возвращает словарь-сводку: found (найдено файлов), processed (успешно), failed (с ошибкой),
+    skipped (пропущено как неизменившиеся или уже обработанные по журналу, плюс нечитаемые директории),
+    failed_files (пути файлов с ошибкой),
+    deduplicated (файлов, взятых из результата дубликата), saved_seconds (время конвертации, которое
+    заняли бы дубликаты), saved_bytes (место, не занятое благодаря reflink и жестким ссылкам),
+    metrics (BatchMetrics.as_dict()) и error (текст ошибки, если пакет не запускался).
+    """
+    summary = {'found': 0, 'processed': 0, 'failed': 0, 'skipped': 0, 'failed_files': [], 'deduplicated': 0,
+               'saved_seconds': 0.0, 'saved_bytes': 0, 'metrics': None, 'error': None}
+    metrics = metrics if metrics is not None else BatchMetrics()
     # Создаем выходную директорию ВСЕГДА в начале, если ее нет
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
         print(f"Создана выходная директория: '{output_dir}'") # Добавим лог
     elif not os.path.isdir(output_dir):
-        print(f"Ошибка: Путь для выходной директории '{output_dir}' существует, но не является директорией.")
-        return # Выходим, если output_dir не директория
+        summary['error'] = f"Путь для выходной директории '{output_dir}' существует, но не является директорией."
+        print(f"Ошибка: {summary['error']}")
+        return summary # Выходим, если output_dir не директория
     # Проверяем существование входной директории
     if not os.path.isdir(input_dir): # Проверяем, что это директория
-        print(f"Ошибка: Входная директория '{input_dir}' не найдена или не является директорией.")
-        return # Выходим, если input_dir не существует или не директория
-    processed_files_count = 0 # Для подсчета обработанных файлов
-    found_files_count = 0
-    for filename in os.listdir(input_dir):
-        if filename.endswith(f".{input_format}"):
-            found_files_count += 1
-            input_path = os.path.join(input_dir, filename)
-            name_without_ext = os.path.splitext(filename)[0]
-            output_path = os.path.join(output_dir, f"{name_without_ext}.{output_format}")
+        summary['error'] = f"Входная директория '{input_dir}' не найдена или не является директорией."
+        print(f"Ошибка: {summary['error']}")
+        return summary # Выходим, если input_dir не существует или не директория
+
+    try:
+        format_map = _parse_format_map(input_format, output_format)
+        _encoder_options(None, encoder_profile) # Неизвестный профиль — ошибка до запуска пакета
+    except ValueError as e:
+        summary['error'] = str(e)
+        print(f"Ошибка: {summary['error']}")
+        return summary
+    options = {}
+    if max_size:
+        options['max_size'] = max_size
+    if encoder_profile:
+        options['encoder_profile'] = encoder_profile
+    if encoder_options:
+        options['encoder_options'] = dict(encoder_options)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = _load_manifest(manifest_path) if incremental else {}
+    unsupported = collections.Counter()
+    batch_journal = None
+    if journal or resume or retry_failed:
+        params = {'input_dir': os.path.abspath(input_dir), 'input_format': input_format,
+                  'output_format': output_format, 'options': options, 'recursive': recursive,
+                  'include': include, 'exclude': exclude}
+        try:
+            batch_journal = BatchJournal(os.path.join(output_dir, JOURNAL_NAME), params,
+                                         resume=resume or retry_failed)
+        except ValueError as e:
+            summary['error'] = str(e)
+            print(f"Ошибка: {summary['error']}")
+            return summary
+
+    def iter_jobs():
+        jobs = iter_candidates()
+        if probe:
+            jobs = route(_run_ahead(lambda job: _probe_file(job[0], job[2]), jobs, probe_threads))
+        for job in jobs:
+            primary = primary_of(job) if dedupe else None
+            if primary is None:
+                yield job
+            elif id(primary) in outcomes: # Исходный файл уже обработан
+                settle_duplicate(primary, job, *outcomes[id(primary)])
+            else:
+                duplicates[id(primary)].append(job)
+
+    def route(probed):
+        """Направляет задания по результату _probe_file; отклоненные сразу учитываются как упавшие."""
+        for job, (content_format, reason, header) in probed:
+            if reason is None and content_format not in BATCH_INPUT_FORMATS:
+                reason = f"содержимое в формате '{content_format}' не поддерживается пакетной конвертацией"
+            if reason is None and not _same_format(content_format, job[2]):
+                reason = _routing_error(content_format, job[3])
+            if reason is not None:
+                print(f"Файл '{job[0]}' отклонен до конвертации: {reason}")
+                metrics.record(job, {'ok': False, 'error': reason})
+                finish(job, False, reason)
+                rejected.append(job)
+                continue
+            if not _same_format(content_format, job[2]):
+                print(f"Файл '{job[0]}' по содержимому в формате '{content_format}', а не '{job[2]}'")
+                job = (job[0], job[1], content_format, job[3], job[4])
+            if header is not None:
+                probed_memory[job[0]] = _header_memory(header, job[4].get('max_size'))
+            yield job
+
+    def skip_dir(path, error):
+        summary['skipped'] += 1
+        print(f"Директория '{path}' пропущена: {error}")
+
+    def iter_candidates():
+        created_dirs = set()
+        for input_path, rel_path in _scan_files(input_dir, recursive, include, exclude, skip_dirs=[output_dir],
+                                                onerror=skip_dir):
+            rel_stem, ext = os.path.splitext(rel_path)
+            file_format = ext.lstrip('.').lower()
+            if file_format not in format_map:
+                continue
+            summary['found'] += 1
+            if file_format not in BATCH_INPUT_FORMATS:
+                unsupported[file_format] += 1
+                continue
+            target_format = format_map[file_format]
+            output_path = os.path.join(output_dir, f"{rel_stem}.{target_format}")
+            target_dir = os.path.dirname(output_path)
+            if target_dir not in created_dirs:
+                os.makedirs(target_dir, exist_ok=True)
+                created_dirs.add(target_dir)
+            params = {'input_format': file_format, 'output_format': target_format, **options}
+            if incremental and _is_up_to_date(manifest.get(rel_path), os.stat(input_path),
+                                              input_path, output_path, params):
+                summary['skipped'] += 1
+                continue
+            if batch_journal is not None:
+                state = batch_journal.state(rel_path)
+                if retry_failed and state != 'failed' or not retry_failed and state in ('done', 'failed'):
+                    summary['skipped'] += 1
+                    continue
+                batch_journal.record(rel_path, 'pending')
+            yield input_path, output_path, file_format, target_format, options
+
+    seen_sizes = {} # Размер -> первое задание этого размера (None, когда оно уже хешировано)
+    primaries = {} # (SHA-256, входной формат, выходной формат) -> задание, которое конвертируется
+    duplicates = collections.defaultdict(list) # id(задания) -> задания с тем же содержимым
+    outcomes = {} # id(задания) -> (ok, секунды конвертации, ошибка) окончательно обработанных заданий
+    late_failed = [] # Дубликаты, упавшие вне цикла результатов раунда
+    rejected = [] # Файлы, отклоненные предварительной проверкой: не повторяются
+    probed_memory = {} # Входной путь -> оценка памяти по заголовку, прочитанному при проверке
+
+    def primary_of(job):
+        """Уже встречавшееся задание с тем же содержимым и форматами или None. Файлы уникального
+        размера не хешируются; первый файл размера хешируется, когда появляется второй.
+        Файл, который не удалось прочитать, не считается дубликатом: ошибку сообщит конвертер."""
+        try:
+            size = os.path.getsize(job[0])
+            if size not in seen_sizes:
+                seen_sizes[size] = job
+                return None
+            first = seen_sizes[size]
+            if first is not None:
+                seen_sizes[size] = None
+                try:
+                    primaries.setdefault((_file_sha256(first[0]), first[2], first[3]), first)
+                except OSError:
+                    pass # Первый файл уже отдан конвертеру, он и сообщит ошибку
+            primary = primaries.setdefault((_file_sha256(job[0]), job[2], job[3]), job)
+        except OSError:
+            return None
+        return None if primary is job else primary
+
+    def settle_duplicate(job, duplicate, ok, seconds, error):
+        """Завершает дубликат окончательно обработанного job: связывает выходной файл с результатом
+        job или, если job упал, учитывает дубликат как упавший с той же ошибкой."""
+        started = time.perf_counter()
+        if ok:
             try:
-                if input_format.lower() in ('jpg', 'png', 'jpeg', 'bmp'):
-                    convert_image(input_path, output_path, output_format)
-                    processed_files_count +=1
-                elif input_format.lower() == 'txt':
-                    convert_text(input_path, output_path, output_format) # output_format здесь может быть не нужен
-                    processed_files_count +=1
-                elif input_format.lower() == 'docx':
-                    convert_docx(input_path, output_path)
-                    processed_files_count +=1
-                # Добавьте другие типы, если необходимо
-            except Exception as e:
-                print(f"Ошибка при конвертации файла '{input_path}': {e}")
-    if found_files_count == 0 and os.path.exists(input_dir): # Добавил проверку существования input_dir
+                method = _clone_file(job[1], duplicate[1])
+            except OSError as e:
+                ok, error = False, str(e)
+        if not ok:
+            print(f"Ошибка при конвертации файла '{duplicate[0]}': {error}")
+            metrics.record(duplicate, {'ok': False, 'error': error})
+            finish(duplicate, False, error)
+            late_failed.append(duplicate)
+            return
+        size = os.path.getsize(duplicate[1])
+        summary['deduplicated'] += 1
+        summary['saved_seconds'] += seconds
+        if method != 'copy':
+            summary['saved_bytes'] += size
+        print(f"Файл '{duplicate[0]}' совпадает с '{job[0]}': результат взят из '{job[1]}'")
+        metrics.record(duplicate, {'ok': True, 'stages': {'dedupe': time.perf_counter() - started},
+                                   'bytes_in': os.path.getsize(duplicate[0]), 'bytes_out': size,
+                                   'deduplicated': True})
+        finish(duplicate, True)
+
+    def record_done(job):
+        input_path, _, _, target_format, _ = job
+        file_format = os.path.splitext(input_path)[1].lstrip('.').lower() # Как в iter_candidates
+        stat = os.stat(input_path)
+        key = os.path.relpath(input_path, input_dir)
+        params = {'input_format': file_format, 'output_format': target_format, **options}
+        manifest[key] = {'input': key, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                         'sha256': _file_sha256(input_path), 'params': params}
+        # Дописываем сразу, чтобы прогресс пережил аварийное завершение пакета
+        manifest_file.write(json.dumps(manifest[key], ensure_ascii=False) + '\n')
+        manifest_file.flush()
+
+    def job_cost(job):
+        # Заголовок изображения уже прочитан предварительной проверкой: второй раз файл не открывается
+        cost = probed_memory.get(job[0])
+        if cost is None:
+            cost = _estimate_job_memory(job[0], job[2], job[4])
+        if io_threads > 0 and job[2] not in PIPELINE_STREAMED_FORMATS: # Конвейер держит в памяти байты файла целиком
+            try:
+                cost += 2 * os.path.getsize(job[0])
+            except OSError:
+                pass # Ошибку чтения сообщит конвейер
+        if cost > memory_budget:
+            print(f"Файл '{job[0]}' требует около {cost // (1024 * 1024)} МБ при бюджете "
+                  f"{memory_budget // (1024 * 1024)} МБ и будет сконвертирован отдельно.")
+        return cost
+
+    def run_round(jobs, final):
+        """Выполняет задания и возвращает упавшие; в метрики упавшие попадают только в последнем раунде."""
+        if io_threads > 0:
+            results = _run_pipeline(jobs, workers, io_threads, monitor=metrics.sample_queue_depth, cache=cache,
+                                    job_cost=job_cost, memory_budget=memory_budget)
+        else:
+            results = _run_jobs(functools.partial(_convert_job, cache=cache), jobs, workers,
+                                monitor=metrics.sample_queue_depth, job_cost=job_cost, memory_budget=memory_budget)
+        failed_jobs = []
+        for job, stats, error in results:
+            ok = error is None and stats['ok']
+            if ok or final:
+                metrics.record(job, stats, error)
+            if error is not None:
+                print(f"Ошибка при конвертации файла '{job[0]}': {error}")
+            elif io_threads > 0 and ok:
+                print(f"Файл '{job[0]}' успешно сконвертирован в '{job[1]}'")
+            if not finish(job, ok, None if ok else error or stats.get('error')):
+                failed_jobs.append(job)
+            if dedupe and (ok or final):
+                # Дубликаты берут результат исходного файла, а при его ошибке упали бы так же
+                outcomes[id(job)] = (ok, sum(stats['stages'].values()) if ok else 0.0,
+                                     None if ok else str(error or stats.get('error')))
+                for duplicate in duplicates.pop(id(job), ()):
+                    settle_duplicate(job, duplicate, *outcomes[id(job)])
+        failed_jobs += late_failed
+        late_failed.clear()
+        return failed_jobs
+
+    def finish(job, ok, error=None):
+        """Отмечает файл в журнале и манифесте и учитывает успех в сводке; возвращает ok."""
+        if batch_journal is not None:
+            batch_journal.record(os.path.relpath(job[0], input_dir), 'done' if ok else 'failed', error)
+        if ok:
+            summary['processed'] += 1
+            if incremental:
+                record_done(job)
+        return ok
+
+    manifest_file = open(manifest_path, 'a', encoding='utf-8') if incremental else None
+    try:
+        failed_jobs = run_round(iter_jobs(), final=retries <= 0)
+        for attempt in range(1, retries + 1):
+            if not failed_jobs:
+                break
+            delay = retry_backoff * 2 ** (attempt - 1)
+            print(f"Повтор {attempt} из {retries} для файлов с ошибкой ({len(failed_jobs)}) через {delay:.1f} с.")
+            time.sleep(delay)
+            failed_jobs = run_round(iter(failed_jobs), final=attempt == retries)
+        summary['failed'] = len(rejected) + len(failed_jobs)
+        summary['failed_files'] = [job[0] for job in rejected + failed_jobs]
+    finally:
+        if incremental:
+            manifest_file.close()
+            _save_manifest(manifest_path, manifest)
+        if batch_journal is not None:
+            batch_journal.close()
+    if unsupported:
+        formats = ', '.join(sorted(unsupported))
+        summary['error'] = f"Неподдерживаемый входной формат для пакетной конвертации: '{formats}'."
+        print(f"Ошибка: {summary['error']}")
+
+    summary['metrics'] = metrics.as_dict()
+    if summary['found'] == 0 and os.path.exists(input_dir): # Добавил проверку существования input_dir
         print(f"В директории '{input_dir}' не найдено файлов с расширением '.{input_format}'.")
-    elif processed_files_count > 0:
-        print(f"Пакетная конвертация завершена. Обработано файлов: {processed_files_count}.")
-    # Если input_dir не существовал, сообщение об этом уже было выведено выше
+    elif summary['processed'] > 0 or summary['failed'] > 0 or summary['skipped'] > 0:
+        print(f"Пакетная конвертация завершена. Обработано файлов: {summary['processed']}. "
+              f"Ошибок: {summary['failed']}. Пропущено без изменений: {summary['skipped']}.")
+        if cache is not None:
+            print(f"Взято из кэша: {metrics.cache_hits}.")
+        if dedupe:
+            print(f"Дубликатов: {summary['deduplicated']}. Сэкономлено около {summary['saved_seconds']:.1f} с "
+                  f"конвертации и {summary['saved_bytes'] / (1024 * 1024):.1f} МБ на диске.")
+    return summary
+
+# --- Несколько вариантов изображения из одного декодирования ---
+def parse_rendition(value):
+    """Разбирает значение --output вида 'шаблон' или 'шаблон:PX' в словарь варианта."""
+    template, sep, max_size = value.rpartition(':')
+    if sep and max_size.isdigit():
+        return {'output': template, 'max_size': int(max_size)}
+    return {'output': value}
+
+def load_renditions(path):
+    """Читает спецификацию вариантов из JSON или YAML (нужен PyYAML).
+
+    Спецификация — список словарей {'output', 'format', 'max_size'} (см. ImageConverter.fan_out)
+    или объект с таким списком в поле 'renditions'.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("Для YAML-спецификации нужен пакет PyYAML (pip install pyyaml)")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if isinstance(spec, dict):
+        spec = spec.get('renditions')
+    if not spec or not isinstance(spec, list) or not all(isinstance(item, dict) and 'output' in item for item in spec):
+        raise ValueError(f"Некорректная спецификация '{path}': нужен список вариантов с полем 'output'")
+    return spec
+
+def _expand_renditions(renditions, rel_path, output_dir):
+    """Подставляет в шаблоны output {stem} (относительный путь входа без расширения) и {name}
+    (имя файла без расширения) и размещает результаты в output_dir."""
+    stem = os.path.splitext(rel_path)[0]
+    return [{**rendition, 'output': os.path.join(output_dir, rendition['output'].format(
+                stem=stem, name=os.path.basename(stem)))}
+            for rendition in renditions]
+
+def _fan_out_job(input_path, renditions):
+    """Задание пула для fan_out_images: все варианты одного входного файла."""
+    converter = get_converter('image')
+    result = converter.fan_out(input_path, renditions)
+    converter.report(result)
+    return dataclasses.asdict(result)
+
+def fan_out_images(inputs, renditions, output_dir='.', workers=1, recursive=False, memory_budget=None):
+    """Сохраняет для каждого входного изображения все варианты из renditions, декодируя его один раз.
+
+    inputs — файлы и директории (из директорий берутся изображения, с recursive=True — и из
+    поддиректорий). В шаблонах output вариантов можно использовать {stem} и {name}
+    (см. _expand_renditions); для нескольких входов шаблон без них недопустим, так как
+    варианты разных файлов перезаписали бы друг друга. Возвращает сводку: found, processed,
+    failed, failed_files, outputs (число созданных файлов) и error. memory_budget — как у batch_convert.
+    """
+    summary = {'found': 0, 'processed': 0, 'failed': 0, 'failed_files': [], 'outputs': 0, 'error': None}
+    if (len(inputs) > 1 or any(os.path.isdir(path) for path in inputs)) and \
+            not all('{stem}' in item['output'] or '{name}' in item['output'] for item in renditions):
+        summary['error'] = "Для нескольких входных файлов шаблоны вывода должны содержать {stem} или {name}"
+        print(f"Ошибка: {summary['error']}")
+        return summary
+
+    def iter_jobs():
+        for path in inputs:
+            if not os.path.isdir(path):
+                summary['found'] += 1
+                yield path, _expand_renditions(renditions, os.path.basename(path), output_dir)
+                continue
+            for input_path, rel_path in _scan_files(path, recursive, skip_dirs=[output_dir],
+                                                    onerror=lambda path, error: print(f"Директория '{path}' пропущена: {error}")):
+                if os.path.splitext(rel_path)[1].lstrip('.').lower() in ImageConverter.input_formats:
+                    summary['found'] += 1
+                    yield input_path, _expand_renditions(renditions, rel_path, output_dir)
+
+    largest = max((item.get('max_size') or math.inf for item in renditions), default=math.inf)
+
+    def job_cost(job):
+        try:
+            return _image_memory(job[0], None if largest == math.inf else largest)
+        except Exception:
+            return 0
+
+    for job, result, error in _run_jobs(_fan_out_job, iter_jobs(), workers, job_cost=job_cost,
+                                        memory_budget=memory_budget):
+        if error is not None:
+            print(f"Ошибка при конвертации файла '{job[0]}': {error}")
+        if error is None and result['ok']:
+            summary['processed'] += 1
+            summary['outputs'] += len(result['output_paths'])
+        else:
+            summary['failed'] += 1
+            summary['failed_files'].append(job[0])
+    print(f"Создано вариантов: {summary['outputs']} из файлов: {summary['processed']}. Ошибок: {summary['failed']}.")
+    return summary
+
+# --- Потоковый режим: tar на входе, tar на выходе ---
+def stream_convert(input_stream, output_stream, input_format, output_format, workers=1, max_size=None,
+                   encoder_profile=None, encoder_options=None):
+    """Конвертирует файлы из tar-потока input_stream и пишет результаты tar-потоком в output_stream.
+
+    Оба архива обрабатываются потоково (режимы tarfile 'r|*' и 'w|'), поэтому пакет проходит через
+    один процесс без временных файлов и без перемотки потоков; подходят каналы и сжатый вход.
+    Элементы отбираются по расширению, как в batch_convert (см. _parse_format_map), а элементы без
+    расширения — по сигнатуре (_sniff_format); остальные пропускаются. Результат получает то же имя
+    с расширением выходного формата. При workers > 1 кодеки работают в пуле процессов, в памяти
+    одновременно не больше 2 * workers файлов, а элементы выдаются в порядке завершения.
+    max_size, encoder_profile и encoder_options — как в batch_convert. Сообщения печатаются в stderr.
+
+    Возвращает сводку: found, processed, failed, failed_files и error.
+    """
+    import tarfile
+    summary = {'found': 0, 'processed': 0, 'failed': 0, 'failed_files': [], 'error': None}
+    try:
+        format_map = _parse_format_map(input_format, output_format)
+        _encoder_options(None, encoder_profile)
+    except ValueError as e:
+        summary['error'] = str(e)
+        print(f"Ошибка: {summary['error']}", file=sys.stderr)
+        return summary
+    options = {}
+    if max_size:
+        options['max_size'] = max_size
+    if encoder_profile:
+        options['encoder_profile'] = encoder_profile
+    if encoder_options:
+        options['encoder_options'] = dict(encoder_options)
+    members = {}
+
+    with tarfile.open(fileobj=input_stream, mode='r|*') as source, \
+            tarfile.open(fileobj=output_stream, mode='w|') as target:
+        def iter_jobs():
+            for member in source:
+                if not member.isfile():
+                    continue
+                stem, ext = os.path.splitext(member.name)
+                file_format = ext.lstrip('.').lower()
+                if file_format not in format_map and ext:
+                    continue
+                data = source.extractfile(member).read() # В режиме 'r|' элемент читается до перехода к следующему
+                if not ext:
+                    file_format = _sniff_format(data[:SNIFF_BYTES], len(data))
+                    if file_format not in format_map:
+                        continue
+                summary['found'] += 1
+                if file_format not in BATCH_INPUT_FORMATS:
+                    summary['failed'] += 1
+                    summary['failed_files'].append(member.name)
+                    print(f"Ошибка: неподдерживаемый входной формат '{file_format}': '{member.name}'", file=sys.stderr)
+                    continue
+                target_format = format_map[file_format]
+                job = (data, file_format, target_format, options)
+                members[id(job)] = (member, f"{stem}.{target_format}")
+                yield job
+
+        for job, result, error in _run_jobs(_transcode_bytes, iter_jobs(), workers):
+            member, name = members.pop(id(job))
+            if error is not None:
+                summary['failed'] += 1
+                summary['failed_files'].append(member.name)
+                print(f"Ошибка при конвертации '{member.name}': {error}", file=sys.stderr)
+                continue
+            data, _ = result
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime, info.mode = len(data), member.mtime, member.mode
+            target.addfile(info, io.BytesIO(data))
+            summary['processed'] += 1
+    print(f"Потоковая конвертация завершена. Обработано файлов: {summary['processed']}. "
+          f"Ошибок: {summary['failed']}.", file=sys.stderr)
+    return summary
+
+# --- Режим сервера ---
+def default_serve_socket():
+    """Путь Unix-сокета сервера по умолчанию: в $XDG_RUNTIME_DIR (директория доступна только владельцу),
+    иначе во временной директории с uid в имени, чтобы сокеты разных пользователей не пересекались."""
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ValueError("Unix-сокеты не поддерживаются на этой платформе, укажите порт TCP")
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'converter.sock')
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), f'converter-{os.getuid()}.sock')
+
+def _serve_job(input_path, output_path, output_format, options):
+    """Задание пула сервера: конвертирует файл и возвращает ConversionResult в виде словаря."""
+    return dataclasses.asdict(convert_file(input_path, output_path, output_format, **options))
+
+def _make_server(host, port, socket_path=None):
+    """Создает HTTP-сервер конвертации; http.server импортируется только здесь, чтобы клиент submit
+    и остальные команды не платили за его загрузку."""
+    import http.server
+    import socketserver
+
+    class ConvertRequestHandler(http.server.BaseHTTPRequestHandler):
+        """HTTP API сервера: GET /health и POST /convert с JSON {input, output, output_format, options}."""
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f"Неизвестный путь: {self.path}"})
+
+        def do_POST(self):
+            if self.path != '/convert':
+                self._send_json(404, {'error': f"Неизвестный путь: {self.path}"})
+                return
+            # Сервер читает и пишет любые файлы пользователя, поэтому запросы из браузера не принимаются:
+            # межсайтовый "простой" POST (text/plain, form) отсекается по типу, остальные — по Origin
+            content_type = self.headers.get('Content-Type', '').split(';', 1)[0].strip().lower()
+            if content_type != 'application/json':
+                self._send_json(415, {'error': "Ожидается Content-Type: application/json"})
+                return
+            if self.headers.get('Origin') is not None:
+                self._send_json(403, {'error': "Запросы из браузера не принимаются"})
+                return
+            try:
+                job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                args = (job['input'], job['output'], job.get('output_format'), dict(job.get('options') or {}))
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {'error': f"Некорректное задание: {e}"})
+                return
+            try:
+                result = self.server.pool.submit(_serve_job, *args).result()
+            except Exception as e: # Например, упавший процесс пула
+                self._send_json(500, {'error': str(e)})
+                return
+            self._send_json(200 if result['ok'] else 422, result)
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # Тысячи запросов в минуту не должны засорять вывод
+
+    class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        """HTTP поверх Unix-сокета: без TCP-стека и без открытого порта."""
+        daemon_threads = True
+
+        def server_bind(self):
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address) # Сокет, оставшийся от прошлого запуска
+            # Сокет создается сразу с правами 0600: подключиться (и тем самым читать и писать файлы
+            # от имени владельца сервера) может только сам пользователь
+            previous_umask = os.umask(0o177)
+            try:
+                super().server_bind()
+            finally:
+                os.umask(previous_umask)
+
+    if socket_path:
+        return ThreadingUnixHTTPServer(socket_path, ConvertRequestHandler)
+    return http.server.ThreadingHTTPServer((host, port), ConvertRequestHandler)
+
+def serve(host='127.0.0.1', port=None, socket_path=None, workers=None):
+    """Запускает долгоживущий сервер конвертации (до Ctrl+C).
+
+    Задания выполняются в пуле из workers прогретых процессов, поэтому каждый запрос не платит
+    за запуск интерпретатора и импорт кодеков. По умолчанию сервер слушает Unix-сокет socket_path
+    (или default_serve_socket()) с правами 0600. TCP host:port не проверяет, кто подключается,
+    поэтому включается только явно заданным port и без socket_path.
+    """
+    if port is None and not socket_path:
+        socket_path = default_serve_socket()
+    workers = workers or os.cpu_count() or 1
+    server = _make_server(host, port, socket_path)
+    address = socket_path or f"http://{host}:{server.server_address[1]}"
+    if threading.current_thread() is threading.main_thread():
+        # SIGTERM (остановка сервиса) завершает сервер так же аккуратно, как Ctrl+C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with server, concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=warm_up_converters) as pool:
+        server.pool = pool
+        print(f"Сервер конвертации слушает {address} (процессов: {workers})", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\nСервер остановлен.")
+        finally:
+            if socket_path and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+def submit_job(input_path, output_path, output_format=None, options=None, host='127.0.0.1',
+               port=None, socket_path=None, timeout=None):
+    """Отправляет задание серверу serve() и возвращает словарь ConversionResult.
+
+    Адрес выбирается так же, как в serve(): без port — Unix-сокет socket_path или default_serve_socket().
+    Пути передаются абсолютными, так как рабочая директория сервера может отличаться.
+    """
+    if port is None and not socket_path:
+        socket_path = default_serve_socket()
+    body = json.dumps({'input': os.path.abspath(input_path), 'output': os.path.abspath(output_path),
+                       'output_format': output_format, 'options': options or {}})
+    import http.client
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        if socket_path:
+            # HTTP поверх Unix-сокета: соединение использует уже подключенный сокет вместо TCP
+            connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.sock.settimeout(timeout)
+            connection.sock.connect(socket_path)
+        connection.request('POST', '/convert', body=body, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        payload = json.loads(response.read())
+    finally:
+        connection.close()
+    if 'ok' not in payload: # Ответ 4xx/5xx без результата конвертации
+        return dataclasses.asdict(ConversionResult(input_path, error=payload.get('error')))
+    return payload
+
+# --- Бенчмарк ---
+# Минимальный docx: для извлечения текста нужен только word/document.xml
+_BENCH_DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>')
+_BENCH_TEXT_LINE = "Строка синтетического журнала: The quick brown fox jumps over the lazy dog 0123456789\n"
+
+def _bench_image(path, size):
+    """Синтетическое изображение: шум в одном канале и градиенты в двух других."""
+    from PIL import Image
+    Image.merge('RGB', [Image.effect_noise(size, 64),
+                        Image.linear_gradient('L').resize(size),
+                        Image.radial_gradient('L').resize(size)]).save(path)
+
+def _bench_docx(path, paragraphs):
+    """Синтетический docx с заданным числом абзацев."""
+    body = ''.join(f'<w:p><w:r><w:t>Абзац {i}: {_BENCH_TEXT_LINE.strip()}</w:t></w:r></w:p>'
+                   for i in range(paragraphs))
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f'<w:body>{body}</w:body></w:document>')
+    import zipfile
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', _BENCH_DOCX_CONTENT_TYPES)
+        zf.writestr('word/document.xml', document)
+
+def _bench_corpus(workdir, small_images, large_images, text_mb, docx_files, pdf_pages):
+    """Создает синтетический набор файлов в workdir и возвращает словарь {вид: список путей}."""
+    from PIL import Image
+    corpus = {}
+    for kind, count, size in (('small_images', small_images, (256, 256)), ('large_images', large_images, (4000, 3000))):
+        kind_dir = os.path.join(workdir, kind)
+        os.makedirs(kind_dir, exist_ok=True)
+        corpus[kind] = []
+        for i in range(count):
+            path = os.path.join(kind_dir, f"img_{i}.jpg")
+            _bench_image(path, size)
+            corpus[kind].append(path)
+    text_path = os.path.join(workdir, "large.txt")
+    line_count = text_mb * 1024 * 1024 // len(_BENCH_TEXT_LINE.encode('utf-8'))
+    with open(text_path, 'w', encoding='utf-8') as f:
+        for _ in range(line_count):
+            f.write(_BENCH_TEXT_LINE)
+    corpus['text'] = [text_path]
+    docx_dir = os.path.join(workdir, "docx")
+    os.makedirs(docx_dir, exist_ok=True)
+    corpus['docx'] = []
+    for i in range(docx_files):
+        path = os.path.join(docx_dir, f"doc_{i}.docx")
+        _bench_docx(path, 2000)
+        corpus['docx'].append(path)
+    pdf_path = os.path.join(workdir, "multipage.pdf")
+    pages = [Image.linear_gradient('L').resize((850, 1100)).convert('RGB') for _ in range(max(pdf_pages, 1))]
+    pages[0].save(pdf_path, save_all=True, append_images=pages[1:])
+    corpus['pdf'] = [pdf_path]
+    return corpus
+
+def _path_size(path):
+    """Размер файла или суммарный размер файлов директории."""
+    if os.path.isdir(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    return os.path.getsize(path)
+
+def _percentile(values, percent):
+    """Перцентиль методом ближайшего ранга."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+def _peak_rss_mb():
+    """Пиковый RSS текущего процесса и его завершившихся потомков, МБ (None, если нет модуля resource)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # В Linux ru_maxrss в килобайтах, в macOS — в байтах
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def _bench_measure(func, jobs, files=None):
+    """Выполняет func(*job) для каждого задания и возвращает метрики. Запускается в отдельном процессе,
+    чтобы пиковый RSS относился только к этому сценарию.
+
+    Задержка измеряется на вызов: если вызов обрабатывает files файлов (пакет, страницы PDF),
+    p50/p99 относятся ко всему запуску, что отмечается в latency_per ('run' вместо 'file').
+    """
+    latencies = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        for job in jobs:
+            job_started = time.perf_counter()
+            func(*job)
+            latencies.append(time.perf_counter() - job_started)
+        elapsed = time.perf_counter() - started
+    files = files if files is not None else len(jobs)
+    bytes_in = sum(_path_size(job[0]) for job in jobs)
+    return {
+        'files': files,
+        'bytes_in': bytes_in,
+        'seconds': elapsed,
+        'files_per_sec': files / elapsed if elapsed else None,
+        'mb_per_sec': bytes_in / (1024 * 1024) / elapsed if elapsed else None,
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p99': _percentile(latencies, 99),
+        'latency_per': 'file' if files == len(jobs) else 'run',
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+# Форматы, для которых бенчмарк сравнивает профили кодирования
+BENCH_ENCODER_FORMATS = ('PNG', 'JPEG', 'WEBP')
+
+def _bench_encoders(paths, output_dir):
+    """Для каждого профиля ENCODER_PROFILES (и умолчаний Pillow под именем 'default') и формата
+    BENCH_ENCODER_FORMATS конвертирует paths и возвращает {профиль: {формат: метрики}}:
+    files, encode_seconds (сумма стадии encode) и bytes_out."""
+    converter = get_converter('image')
+    report = {}
+    for profile in ('default',) + tuple(ENCODER_PROFILES):
+        report[profile] = {}
+        for output_format in BENCH_ENCODER_FORMATS:
+            metrics = {'files': 0, 'encode_seconds': 0.0, 'bytes_out': 0}
+            for i, path in enumerate(paths):
+                output_path = os.path.join(output_dir, f"{profile}_{i}.{output_format.lower()}")
+                result = converter.convert(path, output_path, output_format,
+                                           encoder_profile=None if profile == 'default' else profile)
+                if result.ok:
+                    metrics['files'] += 1
+                    metrics['encode_seconds'] += result.stages.get('encode', 0.0)
+                    metrics['bytes_out'] += result.bytes_out
+            report[profile][output_format] = metrics
+    return report
+
+def _import_time_ms(module='main', tries=3):
+    """Время холодного импорта модуля в свежем интерпретаторе по -X importtime, мс (лучшее из tries)."""
+    import subprocess
+    best = None
+    for _ in range(tries):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                              check=True)
+        for line in proc.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            parts = [part.strip() for part in line.split('|')]
+            if len(parts) == 3 and parts[2] == module:
+                cumulative = int(parts[1]) / 1000
+                best = cumulative if best is None else min(best, cumulative)
+    return best
+
+def _bench_startup(tries=3):
+    """Стоимость запуска: холодный импорт модуля и полный вызов main.py --help в новом процессе."""
+    import subprocess
+    help_seconds = []
+    for _ in range(tries):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--help'], capture_output=True, check=True)
+        help_seconds.append(time.perf_counter() - started)
+    return {'import_ms': _import_time_ms(tries=tries), 'help_seconds': min(help_seconds)}
+
+def run_benchmarks(workdir=None, small_images=200, large_images=4, text_mb=64, docx_files=20, pdf_pages=20,
+                   workers=None):
+    """Генерирует синтетический набор файлов и измеряет скорость всех путей конвертации.
+
+    Каждый сценарий выполняется в свежем процессе. Возвращает словарь с описанием окружения
+    и метриками по сценариям: files_per_sec, mb_per_sec, latency_p50/p99 (секунды на файл,
+    а для batch_convert и convert_pdf_to_image — на весь запуск, см. latency_per) и peak_rss_mb. В разделе startup — время холодного импорта модуля и запуска main.py --help,
+    в разделе encoders — время кодирования и размер результата по профилям (_bench_encoders).
+    """
+    import tempfile
+    workers = workers or os.cpu_count() or 1
+    startup = _bench_startup()
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        corpus = _bench_corpus(tmp, small_images, large_images, text_mb, docx_files, pdf_pages)
+        out = os.path.join(tmp, 'out')
+        os.makedirs(out)
+        cases = {
+            'convert_image_small': (convert_image, [(p, os.path.join(out, f"small_{i}.png"), 'PNG')
+                                                    for i, p in enumerate(corpus['small_images'])]),
+            'convert_image_large': (convert_image, [(p, os.path.join(out, f"large_{i}.png"), 'PNG')
+                                                    for i, p in enumerate(corpus['large_images'])]),
+            'convert_text_copy': (convert_text, [(corpus['text'][0], os.path.join(out, 'copy.txt'), 'txt')]),
+            'convert_text_transcode': (convert_text, [(corpus['text'][0], os.path.join(out, 'transcoded.txt'), 'txt',
+                                                       'utf-8', 'utf-16', 'crlf')]),
+            'convert_docx': (convert_docx, [(p, os.path.join(out, f"doc_{i}.txt"))
+                                            for i, p in enumerate(corpus['docx'])]),
+            'batch_convert': (batch_convert, [(os.path.dirname(corpus['small_images'][0]),
+                                               os.path.join(out, 'batch'), 'jpg', 'png', workers)],
+                              len(corpus['small_images'])),
+        }
+        if shutil.which('pdftoppm'):
+            cases['convert_pdf_to_image'] = (convert_pdf_to_image, [(corpus['pdf'][0], os.path.join(out, 'pdf'))],
+                                             pdf_pages)
+        results = {}
+        for name, case in cases.items():
+            if not case[1]:
+                continue
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+                results[name] = pool.submit(_bench_measure, *case).result()
+        images = corpus['small_images'] + corpus['large_images']
+        encoders_dir = os.path.join(out, 'encoders')
+        os.makedirs(encoders_dir)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            encoders = pool.submit(_bench_encoders, images, encoders_dir).result() if images else {}
+    import platform
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'workers': workers,
+        'startup': startup,
+        'cases': results,
+        'encoders': encoders,
+    }
+
 def main():
     parser = argparse.ArgumentParser(description="Конвертер файлов")
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'], help='Профилировать выполнение команды')
+    parser.add_argument('--profile-output', help='Файл для отчета профилировщика (по умолчанию stderr)')
     subparsers = parser.add_subparsers(dest='command', help='Выберите команду')
     subparsers.required = False # Делаем команду необязательной для интерактивного режима
 
     # Парсер для одиночной конвертации
     convert_parser = subparsers.add_parser('convert', help='Конвертировать один файл')
-    convert_parser.add_argument('input', help='Путь к входному файлу')
-    convert_parser.add_argument('output', help='Путь к выходному файлу')
+    convert_parser.add_argument('input', help="Путь к входному файлу или '-' для stdin (формат определяется по сигнатуре)")
+    convert_parser.add_argument('output', help="Путь к выходному файлу или '-' для stdout")
     convert_parser.add_argument('-f', '--format', help='Формат выходного файла (для изображений)')
+    convert_parser.add_argument('--max-size', '--thumbnail', type=int, dest='max_size', metavar='PX', help='Уменьшить изображение так, чтобы большая сторона не превышала PX пикселей')
+    convert_parser.add_argument('--encoding', default='utf-8', help="Кодировка входного текстового файла или 'auto' (по умолчанию utf-8)")
+    convert_parser.add_argument('--target-encoding', default='utf-8', help='Кодировка выходного текстового файла (по умолчанию utf-8)')
+    convert_parser.add_argument('--newline', choices=sorted(NEWLINES), help='Привести переводы строк в тексте к указанному виду')
+    convert_parser.add_argument('--encoder-profile', choices=list(ENCODER_PROFILES), help='Профиль кодирования изображений: fast — быстрее, smallest — меньше файл (по умолчанию умолчания Pillow)')
+    convert_parser.add_argument('--encoder-option', action='append', type=parse_encoder_option, metavar='КЛЮЧ=ЗНАЧЕНИЕ', help='Параметр кодировщика Pillow, например quality=85 или progressive=true (можно указать несколько раз)')
+    convert_parser.add_argument('--no-probe', dest='probe', action='store_false', help='Не проверять файл перед конвертацией: формат берется из расширения (по умолчанию определяется по содержимому, а поврежденный файл отклоняется сразу)')
+    convert_parser.add_argument('--images-dir', help='Сохранить изображения из docx в эту директорию (по умолчанию не извлекаются)')
+    convert_parser.add_argument('--cache-dir', help='Директория кэша результатов: повторяющиеся по содержимому файлы не конвертируются заново')
+    convert_parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024), metavar='MB', help=f'Бюджет кэша в МБ; давно не использованные записи вытесняются (по умолчанию {DEFAULT_CACHE_SIZE // (1024 * 1024)})')
 
     # Парсер для пакетной конвертации
     batch_parser = subparsers.add_parser('batch', help='Пакетная конвертация')
     batch_parser.add_argument('input_dir', help='Путь к входной директории')
     batch_parser.add_argument('output_dir', help='Путь к выходной директории')
-    batch_parser.add_argument('input_format', help='Входной формат файлов (например, jpg, png, txt, docx)')
-    batch_parser.add_argument('output_format', help='Выходной формат файлов (например, jpg, png, txt)')
+    batch_parser.add_argument('input_format', help='Входной формат файлов (например, jpg, png, txt, docx) или несколько через запятую: jpg,png,docx')
+    batch_parser.add_argument('output_format', help='Выходной формат файлов (например, jpg, png, txt): один для всех или по одному на каждый входной через запятую')
+    batch_parser.add_argument('-r', '--recursive', action='store_true', help='Обходить поддиректории, повторяя их структуру в выходной директории')
+    batch_parser.add_argument('--include', action='append', metavar='GLOB', help='Обрабатывать только файлы, подходящие под шаблон (можно указать несколько раз)')
+    batch_parser.add_argument('--exclude', action='append', metavar='GLOB', help='Пропускать файлы и директории, подходящие под шаблон (можно указать несколько раз)')
+    batch_parser.add_argument('-w', '--workers', type=int, default=1, help='Число процессов для параллельной конвертации (по умолчанию 1)')
+    batch_parser.add_argument('--summary', help='Путь к JSON-файлу для сводки по пакету')
+    batch_parser.add_argument('--max-size', '--thumbnail', type=int, dest='max_size', metavar='PX', help='Уменьшить изображения так, чтобы большая сторона не превышала PX пикселей')
+    batch_parser.add_argument('--no-probe', dest='probe', action='store_false', help='Не проверять файлы перед конвертацией (по умолчанию формат определяется по содержимому, а поврежденные файлы отклоняются сразу)')
+    batch_parser.add_argument('--dedupe', action='store_true', help='Конвертировать файлы с одинаковым содержимым один раз, остальные результаты связывать (reflink или жесткая ссылка)')
+    batch_parser.add_argument('--encoder-profile', choices=list(ENCODER_PROFILES), help='Профиль кодирования изображений: fast — быстрее, smallest — меньше файлы (по умолчанию умолчания Pillow)')
+    batch_parser.add_argument('--encoder-option', action='append', type=parse_encoder_option, metavar='КЛЮЧ=ЗНАЧЕНИЕ', help='Параметр кодировщика Pillow, например quality=85 (можно указать несколько раз)')
+    batch_parser.add_argument('--io-threads', type=int, default=0, help='Потоков чтения и записи; больше 0 включает конвейер чтение/кодеки/запись (по умолчанию 0)')
+    batch_parser.add_argument('--metrics-jsonl', help='Дописывать метрики по каждому файлу в JSON-lines файл')
+    batch_parser.add_argument('--metrics-prom', help='Записать сводные метрики в текстовом формате Prometheus')
+    batch_parser.add_argument('--memory-budget', type=int, metavar='MB', help='Бюджет памяти на параллельные задания в МБ (по умолчанию половина физической памяти)')
+    batch_parser.add_argument('--resume', action='store_true', help='Продолжить прерванный пакет по журналу в выходной директории')
+    batch_parser.add_argument('--retry-failed', action='store_true', help='Обработать только файлы, упавшие в прошлых запусках (по журналу)')
+    batch_parser.add_argument('--retries', type=int, help='Сколько раз повторять упавшие файлы с растущей паузой (по умолчанию 3 с --retry-failed, иначе 0)')
+    batch_parser.add_argument('--retry-backoff', type=float, default=1.0, metavar='SEC', help='Пауза перед первым повтором в секундах, далее удваивается (по умолчанию 1)')
+    batch_parser.add_argument('--no-journal', dest='journal', action='store_false', help='Не вести журнал состояний файлов')
+    batch_parser.add_argument('--incremental', action='store_true', help='Пропускать файлы, не изменившиеся с прошлого запуска (манифест в выходной директории)')
+    batch_parser.add_argument('--cache-dir', help='Директория кэша результатов: повторяющиеся по содержимому файлы не конвертируются заново')
+    batch_parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024), metavar='MB', help=f'Бюджет кэша в МБ; давно не использованные записи вытесняются (по умолчанию {DEFAULT_CACHE_SIZE // (1024 * 1024)})')
 
     pdf_parser = subparsers.add_parser('pdf2img', help='Конвертировать PDF в изображения')
     pdf_parser.add_argument('input', help='Путь к PDF файлу')
     pdf_parser.add_argument('output_dir', help='Путь к выходной директории')
+    pdf_parser.add_argument('--first-page', type=int, help='Первая страница диапазона (с 1)')
+    pdf_parser.add_argument('--last-page', type=int, help='Последняя страница диапазона (включительно)')
+    pdf_parser.add_argument('--dpi', type=int, default=200, help='Разрешение рендеринга (по умолчанию 200)')
+    pdf_parser.add_argument('-f', '--format', default='jpeg', choices=sorted(PDF_PAGE_FORMATS), help='Формат страниц (по умолчанию jpeg)')
+    pdf_parser.add_argument('--quality', type=int, help='Качество JPEG/WebP от 1 до 100')
+    pdf_parser.add_argument('--grayscale', action='store_true', help='Рендерить страницы в оттенках серого')
+    pdf_parser.add_argument('--chunk-size', type=int, default=PDF_CHUNK_PAGES, help=f'Сколько страниц рендерить за раз (по умолчанию {PDF_CHUNK_PAGES})')
+    pdf_parser.add_argument('-w', '--workers', type=int, default=1, help='Число процессов рендеринга (по умолчанию 1)')
+    pdf_parser.add_argument('--memory-budget', type=int, metavar='MB', help='Бюджет памяти на параллельные задания в МБ (по умолчанию половина физической памяти)')
+    pdf_parser.add_argument('--cache-dir', help='Директория кэша результатов: повторяющиеся по содержимому файлы не конвертируются заново')
+    pdf_parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024), metavar='MB', help=f'Бюджет кэша в МБ; давно не использованные записи вытесняются (по умолчанию {DEFAULT_CACHE_SIZE // (1024 * 1024)})')
+
+    fanout_parser = subparsers.add_parser('fanout', help='Сохранить несколько вариантов изображения за одно декодирование')
+    fanout_parser.add_argument('inputs', nargs='+', help='Входные изображения или директории с ними')
+    fanout_parser.add_argument('-o', '--output', action='append', metavar='ШАБЛОН[:PX]', help="Выходной вариант: путь или шаблон с {stem}/{name}, после ':' — большая сторона в пикселях (можно указать несколько раз)")
+    fanout_parser.add_argument('--spec', help='JSON или YAML файл со списком вариантов (output, format, max_size)')
+    fanout_parser.add_argument('--output-dir', default='.', help='Директория, относительно которой строятся выходные пути (по умолчанию текущая)')
+    fanout_parser.add_argument('-r', '--recursive', action='store_true', help='Обходить поддиректории входных директорий')
+    fanout_parser.add_argument('-w', '--workers', type=int, default=1, help='Число процессов (по умолчанию 1)')
+    fanout_parser.add_argument('--memory-budget', type=int, metavar='MB', help='Бюджет памяти на параллельные задания в МБ (по умолчанию половина физической памяти)')
+
+    stream_parser = subparsers.add_parser('stream', help='Потоковая конвертация: tar-архив на входе, tar-архив на выходе')
+    stream_parser.add_argument('input_format', help='Входной формат файлов или несколько через запятую: jpg,png,docx')
+    stream_parser.add_argument('output_format', help='Выходной формат файлов: один для всех или по одному на каждый входной через запятую')
+    stream_parser.add_argument('-i', '--input', default=STDIO, help="Входной tar-архив (в том числе сжатый) или '-' для stdin (по умолчанию)")
+    stream_parser.add_argument('-o', '--output', default=STDIO, help="Выходной tar-архив или '-' для stdout (по умолчанию)")
+    stream_parser.add_argument('-w', '--workers', type=int, default=1, help='Число процессов для параллельной конвертации (по умолчанию 1)')
+    stream_parser.add_argument('--max-size', '--thumbnail', type=int, dest='max_size', metavar='PX', help='Уменьшить изображения так, чтобы большая сторона не превышала PX пикселей')
+    stream_parser.add_argument('--encoder-profile', choices=list(ENCODER_PROFILES), help='Профиль кодирования изображений (см. convert)')
+    stream_parser.add_argument('--encoder-option', action='append', type=parse_encoder_option, metavar='КЛЮЧ=ЗНАЧЕНИЕ', help='Параметр кодировщика Pillow (можно указать несколько раз)')
+
+    serve_parser = subparsers.add_parser('serve', help='Запустить сервер конвертации (HTTP или Unix-сокет)')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Адрес для TCP (по умолчанию 127.0.0.1)')
+    serve_parser.add_argument('--port', type=int, help='Слушать TCP на этом порту вместо Unix-сокета (без аутентификации)')
+    serve_parser.add_argument('--socket', help='Путь Unix-сокета (по умолчанию $XDG_RUNTIME_DIR/converter.sock)')
+    serve_parser.add_argument('-w', '--workers', type=int, help='Число процессов конвертации (по умолчанию число ядер)')
+
+    submit_parser = subparsers.add_parser('submit', help='Отправить файл на конвертацию запущенному серверу')
+    submit_parser.add_argument('input', help='Путь к входному файлу')
+    submit_parser.add_argument('output', help='Путь к выходному файлу (для PDF — директории)')
+    submit_parser.add_argument('-f', '--format', help='Формат выходного файла (для изображений)')
+    submit_parser.add_argument('--max-size', '--thumbnail', type=int, dest='max_size', metavar='PX', help='Уменьшить изображение так, чтобы большая сторона не превышала PX пикселей')
+    submit_parser.add_argument('--host', default='127.0.0.1', help='Адрес сервера для TCP (по умолчанию 127.0.0.1)')
+    submit_parser.add_argument('--port', type=int, help='Порт сервера, слушающего TCP')
+    submit_parser.add_argument('--socket', help='Unix-сокет сервера (по умолчанию тот же, что у serve)')
+
+    bench_parser = subparsers.add_parser('bench', help='Измерить производительность конвертации на синтетических файлах')
+    bench_parser.add_argument('-o', '--output', help='Путь к JSON-файлу с результатами')
+    bench_parser.add_argument('--workdir', help='Где создавать временные файлы (по умолчанию системная временная директория)')
+    bench_parser.add_argument('--small-images', type=int, default=200, help='Число маленьких изображений 256x256 (по умолчанию 200)')
+    bench_parser.add_argument('--large-images', type=int, default=4, help='Число больших изображений 4000x3000 (по умолчанию 4)')
+    bench_parser.add_argument('--text-mb', type=int, default=64, help='Размер текстового файла в МБ (по умолчанию 64)')
+    bench_parser.add_argument('--docx-files', type=int, default=20, help='Число docx файлов (по умолчанию 20)')
+    bench_parser.add_argument('--pdf-pages', type=int, default=20, help='Число страниц PDF (по умолчанию 20)')
+    bench_parser.add_argument('-w', '--workers', type=int, help='Число процессов для batch_convert (по умолчанию число ядер)')
+    bench_parser.add_argument('--max-import-ms', type=float, metavar='MS',
+                              help='Порог времени холодного импорта в мс: при превышении команда завершается с кодом 1')
 
     args = parser.parse_args()
 
@@ -104,47 +2645,188 @@ def main():
 
     # Если команда была передана через CLI, выполняем её и выходим
     if args.command:
-        try:
-            if args.command == 'convert':
-                if not os.path.exists(args.input):
-                    print(f"Ошибка: Входной файл '{args.input}' не найден.", file=sys.stderr)
-                    sys.exit(1) # Важно выходить с ошибкой
-
-                pil_format = args.format
-                # Определение формата, если он не задан явно для изображений
-                if args.input.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff')) and not pil_format:
-                    _, output_ext = os.path.splitext(args.output)
-                    pil_format = output_ext.lstrip('.').upper()
-                    if not pil_format:
-                        print("Ошибка: Для конвертации изображения необходимо указать выходной формат с помощью опции -f или через расширение имени выходного файла.", file=sys.stderr)
+        memory_budget = None
+        if 'memory_budget' in args:
+            memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else _default_memory_budget()
+        cache = None
+        if getattr(args, 'cache_dir', None):
+            cache = ConversionCache(args.cache_dir, max_bytes=args.cache_size * 1024 * 1024)
+        with _profiling(args.profile, args.profile_output):
+            try:
+                if args.command == 'convert':
+                    if args.input != STDIO and not os.path.exists(args.input):
+                        print(f"Ошибка: Входной файл '{args.input}' не найден.", file=sys.stderr)
+                        sys.exit(1) # Важно выходить с ошибкой
+
+                    # Формат входа по содержимому: для stdin — по сигнатуре первых байтов, для файла —
+                    # предварительной проверкой заголовка (расширение учитывается, только если сигнатура не распознана)
+                    output_format = args.format or os.path.splitext(args.output)[1].lstrip('.')
+                    if args.input == STDIO:
+                        # Расширения у stdin нет: конвертер выбран по содержимому, и он должен уметь дать выходной формат
+                        input_format = _sniff_stdin()
+                        reason = _routing_error(input_format, output_format) if input_format and output_format else None
+                        if reason is not None:
+                            print(f"Ошибка: Данные stdin не могут быть сконвертированы: {reason}", file=sys.stderr)
+                            sys.exit(1)
+                    elif not args.probe:
+                        input_format = os.path.splitext(args.input)[1].lstrip('.').lower()
+                    else:
+                        extension_format = os.path.splitext(args.input)[1].lstrip('.').lower()
+                        input_format, reason, _ = _probe_file(args.input, extension_format)
+                        if reason is None and output_format and not _same_format(input_format, extension_format):
+                            reason = _routing_error(input_format, output_format)
+                        if reason is not None:
+                            print(f"Ошибка: Файл '{args.input}' не может быть сконвертирован: {reason}", file=sys.stderr)
+                            sys.exit(1)
+                    pil_format = args.format
+                    # Определение формата, если он не задан явно для изображений
+                    if input_format in ImageConverter.input_formats and not pil_format:
+                        _, output_ext = os.path.splitext(args.output)
+                        pil_format = output_ext.lstrip('.').upper()
+                        if not pil_format:
+                            print("Ошибка: Для конвертации изображения необходимо указать выходной формат с помощью опции -f или через расширение имени выходного файла.", file=sys.stderr)
+                            sys.exit(1)
+                        if pil_format == 'JPG': pil_format = 'JPEG'
+
+
+                    if input_format in ImageConverter.input_formats:
+                        ok = convert_image(args.input, args.output, pil_format, max_size=args.max_size, cache=cache,
+                                           encoder_profile=args.encoder_profile,
+                                           encoder_options=dict(args.encoder_option or ()))
+                    elif input_format == 'txt':
+                        ok = convert_text(args.input, args.output, pil_format if pil_format else 'txt', # pil_format здесь может быть нерелевантен
+                                          encoding=args.encoding, target_encoding=args.target_encoding,
+                                          newline=args.newline, cache=cache)
+                    elif input_format == 'docx':
+                        ok = convert_docx(args.input, args.output, cache=cache, images_dir=args.images_dir)
+                    else:
+                        print(f"Ошибка: Неподдерживаемый формат входного файла для команды 'convert': {args.input}", file=sys.stderr)
                         sys.exit(1)
-                    if pil_format == 'JPG': pil_format = 'JPEG'
+                    if not ok:
+                        exit_code = 1
 
+                elif args.command == 'batch':
+                    metrics = BatchMetrics(args.metrics_jsonl)
+                    try:
+                        summary = batch_convert(args.input_dir, args.output_dir, args.input_format, args.output_format,
+                                                workers=args.workers, incremental=args.incremental,
+                                                max_size=args.max_size, io_threads=args.io_threads, metrics=metrics,
+                                                recursive=args.recursive, include=args.include, exclude=args.exclude,
+                                                cache=cache, memory_budget=memory_budget, journal=args.journal,
+                                                resume=args.resume, retry_failed=args.retry_failed,
+                                                retries=args.retries if args.retries is not None else (3 if args.retry_failed else 0),
+                                                retry_backoff=args.retry_backoff, encoder_profile=args.encoder_profile,
+                                                encoder_options=dict(args.encoder_option or ()), dedupe=args.dedupe,
+                                                probe=args.probe)
+                    finally:
+                        metrics.close()
+                    if args.metrics_prom:
+                        metrics.write_prometheus(args.metrics_prom)
+                    if args.summary:
+                        with open(args.summary, 'w', encoding='utf-8') as f:
+                            json.dump(summary, f, ensure_ascii=False, indent=2)
+                    if summary['error'] or summary['failed']:
+                        exit_code = 1
 
-                if args.input.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff')):
-                    convert_image(args.input, args.output, pil_format)
-                elif args.input.lower().endswith('.txt'):
-                    convert_text(args.input, args.output, pil_format if pil_format else 'txt') # pil_format здесь может быть нерелевантен
-                elif args.input.lower().endswith('.docx'):
-                    convert_docx(args.input, args.output)
-                else:
-                    print(f"Ошибка: Неподдерживаемый формат входного файла для команды 'convert': {args.input}", file=sys.stderr)
-                    sys.exit(1)
+                elif args.command == 'stream':
+                    import tarfile
+                    try:
+                        with contextlib.ExitStack() as stack:
+                            source = sys.stdin.buffer if args.input == STDIO else stack.enter_context(open(args.input, 'rb'))
+                            target = sys.stdout.buffer if args.output == STDIO else stack.enter_context(open(args.output, 'wb'))
+                            summary = stream_convert(source, target, args.input_format, args.output_format,
+                                                     workers=args.workers, max_size=args.max_size,
+                                                     encoder_profile=args.encoder_profile,
+                                                     encoder_options=dict(args.encoder_option or ()))
+                    except (OSError, tarfile.TarError) as e:
+                        print(f"Ошибка: не удалось обработать tar-поток: {e}", file=sys.stderr)
+                        exit_code = 1
+                    else:
+                        if summary['error'] or summary['failed']:
+                            exit_code = 1
+
+                elif args.command == 'pdf2img':
+                    if not convert_pdf_to_image(args.input, args.output_dir, first_page=args.first_page,
+                                                last_page=args.last_page, dpi=args.dpi,
+                                                chunk_size=args.chunk_size, workers=args.workers, cache=cache,
+                                                memory_budget=memory_budget, output_format=args.format,
+                                                quality=args.quality, grayscale=args.grayscale):
+                        exit_code = 1
 
-            elif args.command == 'batch':
-                batch_convert(args.input_dir, args.output_dir, args.input_format, args.output_format)
+                elif args.command == 'fanout':
+                    try:
+                        renditions = load_renditions(args.spec) if args.spec else []
+                        renditions += [parse_rendition(value) for value in args.output or []]
+                    except (OSError, ValueError) as e: # ValueError включает json.JSONDecodeError
+                        print(f"Ошибка: не удалось прочитать варианты: {e}", file=sys.stderr)
+                        sys.exit(1)
+                    if not renditions:
+                        print("Ошибка: Укажите варианты через --output или --spec.", file=sys.stderr)
+                        sys.exit(1)
+                    summary = fan_out_images(args.inputs, renditions, args.output_dir, workers=args.workers,
+                                             recursive=args.recursive, memory_budget=memory_budget)
+                    if summary['error'] or summary['failed']:
+                        exit_code = 1
 
-            elif args.command == 'pdf2img':
-                convert_pdf_to_image(args.input, args.output_dir)
+                elif args.command == 'serve':
+                    try:
+                        serve(args.host, args.port, socket_path=args.socket, workers=args.workers)
+                    except ValueError as e:
+                        print(f"Ошибка: {e}", file=sys.stderr)
+                        sys.exit(1)
 
-        except FileNotFoundError as e:
-            print(f"Ошибка FileNotFoundError: {e}", file=sys.stderr)
-            exit_code = 1
-        except Exception as e:
-            # Функции конвертации уже печатают свои ошибки
-            # Но мы хотим, чтобы CLI вернул ненулевой код
-            # print(f"Произошла ошибка при выполнении команды '{args.command}': {e}", file=sys.stderr) # Можно раскомментировать для доп. отладки
-            exit_code = 1 # Сигнализируем об ошибке
+                elif args.command == 'submit':
+                    options = {'max_size': args.max_size} if args.max_size else {}
+                    try:
+                        result = submit_job(args.input, args.output, args.format, options, host=args.host,
+                                            port=args.port, socket_path=args.socket)
+                    except (OSError, ValueError) as e: # ConnectionError и ответ не в JSON
+                        print(f"Ошибка: не удалось отправить задание серверу: {e}", file=sys.stderr)
+                        sys.exit(1)
+                    if result['ok']:
+                        for output_path in result['output_paths']:
+                            print(f"Файл '{args.input}' успешно сконвертирован в '{output_path}'")
+                    else:
+                        print(f"Ошибка при конвертации файла '{args.input}': {result['error']}", file=sys.stderr)
+                        exit_code = 1
+
+                elif args.command == 'bench':
+                    import subprocess
+                    try:
+                        report = run_benchmarks(args.workdir, small_images=args.small_images,
+                                                large_images=args.large_images, text_mb=args.text_mb,
+                                                docx_files=args.docx_files, pdf_pages=args.pdf_pages,
+                                                workers=args.workers)
+                    except (OSError, subprocess.SubprocessError) as e:
+                        print(f"Ошибка: бенчмарк не выполнен: {e}", file=sys.stderr)
+                        sys.exit(1)
+                    for name, case in report['cases'].items():
+                        rss = f"{case['peak_rss_mb']:.1f} МБ" if case['peak_rss_mb'] is not None else "н/д"
+                        per = "на файл" if case['latency_per'] == 'file' else "на запуск"
+                        print(f"{name}: {case['files_per_sec']:.1f} файлов/с, {case['mb_per_sec']:.1f} МБ/с, "
+                              f"p50 {case['latency_p50'] * 1000:.1f} мс, p99 {case['latency_p99'] * 1000:.1f} мс {per}, "
+                              f"пик RSS {rss}")
+                    for profile, formats in report['encoders'].items():
+                        print(f"профиль {profile}: " + ", ".join(
+                            f"{fmt} {metrics['encode_seconds'] * 1000:.0f} мс / {metrics['bytes_out'] / 1024:.0f} КБ"
+                            for fmt, metrics in formats.items()))
+                    if args.output:
+                        with open(args.output, 'w', encoding='utf-8') as f:
+                            json.dump(report, f, ensure_ascii=False, indent=2)
+                    import_ms = report['startup']['import_ms']
+                    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+                        print(f"Ошибка: холодный импорт занял {import_ms:.1f} мс, порог {args.max_import_ms:.1f} мс",
+                              file=sys.stderr)
+                        exit_code = 1
+
+            except FileNotFoundError as e:
+                print(f"Ошибка FileNotFoundError: {e}", file=sys.stderr)
+                exit_code = 1
+            except Exception as e:
+                # Функции конвертации сами печатают ожидаемые ошибки; сюда попадают только непредвиденные,
+                # и молча выходить с кодом 1 нельзя
+                print(f"Произошла ошибка при выполнении команды '{args.command}': {e}", file=sys.stderr)
+                exit_code = 1 # Сигнализируем об ошибке
 
         sys.exit(exit_code) # Выходим после выполнения CLI команды
 
@@ -3,6 +3,10 @@ import shutil
 import subprocess
 import pytest
 import sys
+import json
+import time
+import socket
+import tempfile
 import chardet
 from PIL import Image
 
@@ -51,6 +55,109 @@ def test_cli_convert_docx_to_txt():
         content = f.read()
     assert "Test DOCX content" in content
 
+def test_cli_convert_stdin_to_stdout_sniffs_format():
+    with open(os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg"), "rb") as f:
+        result = subprocess.run([sys.executable, CONVERTER_SCRIPT, "convert", "-", "-", "-f", "PNG"],
+                                input=f.read(), capture_output=True, check=False)
+
+    assert result.returncode == 0, result.stderr.decode()
+    assert result.stdout.startswith(b"\x89PNG") # Сообщения ушли в stderr, stdout — только данные
+    assert "успешно сконвертировано в '-'" in result.stderr.decode()
+
+def test_cli_convert_stdin_sniffs_format_across_short_reads():
+    # Первый фрагмент канала короче сигнатуры: формат определяется после дочитывания
+    with open(os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg"), "rb") as f:
+        data = f.read()
+    output_file = os.path.join(OUTPUT_DIR_FUNC, "short_reads.png")
+    process = subprocess.Popen([sys.executable, CONVERTER_SCRIPT, "convert", "-", output_file],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process.stdin.write(data[:2])
+    process.stdin.flush()
+    time.sleep(0.5)
+    process.stdin.write(data[2:])
+    process.stdin.close()
+    stderr = process.stderr.read().decode()
+    process.stdout.read()
+
+    assert process.wait(timeout=30) == 0, stderr
+    assert Image.open(output_file).format == "PNG"
+
+def test_cli_convert_stdin_rejects_output_format_of_other_kind():
+    output_file = os.path.join(OUTPUT_DIR_FUNC, "stdin_text.png")
+    result = subprocess.run([sys.executable, CONVERTER_SCRIPT, "convert", "-", output_file],
+                            input=b"hello", capture_output=True, check=False)
+
+    assert result.returncode == 1
+    assert "нельзя сконвертировать в 'png'" in result.stderr.decode()
+    assert not os.path.exists(output_file)
+
+def test_cli_convert_stdin_text_starting_with_bmp_signature():
+    # "BM" в начале текста — не BMP: заголовок проверяется целиком
+    result = subprocess.run([sys.executable, CONVERTER_SCRIPT, "convert", "-", "-"],
+                            input="BMW report\n".encode(), capture_output=True, check=False)
+
+    assert result.returncode == 0, result.stderr.decode()
+    assert result.stdout.decode() == "BMW report\n"
+
+def test_cli_convert_text_file_starting_with_bmp_signature():
+    input_file = os.path.join(OUTPUT_DIR_FUNC, "bmw_report.txt")
+    with open(input_file, "w", encoding="utf-8") as f:
+        f.write("BMW quarterly report\n")
+    output_file = os.path.join(OUTPUT_DIR_FUNC, "bmw_report_out.txt")
+
+    result = run_script(["convert", input_file, output_file])
+
+    assert result.returncode == 0, result.stderr
+    with open(output_file, encoding="utf-8") as f:
+        assert f.read() == "BMW quarterly report\n"
+
+def test_cli_convert_rejects_image_misnamed_as_text():
+    input_file = os.path.join(OUTPUT_DIR_FUNC, "picture.txt")
+    Image.new("RGB", (8, 8)).save(input_file, "PNG")
+    output_file = os.path.join(OUTPUT_DIR_FUNC, "picture_out.txt")
+
+    result = run_script(["convert", input_file, output_file])
+
+    assert result.returncode != 0
+    assert "нельзя сконвертировать в 'txt'" in result.stderr
+    assert not os.path.exists(output_file)
+
+def test_cli_convert_exits_nonzero_when_conversion_fails():
+    input_file = os.path.join(OUTPUT_DIR_FUNC, "transparent.png")
+    Image.new("RGBA", (8, 8)).save(input_file)
+
+    result = run_script(["convert", input_file, os.path.join(OUTPUT_DIR_FUNC, "transparent.jpg")])
+
+    assert result.returncode == 1 # JPEG не поддерживает альфа-канал
+    assert "Ошибка при конвертации изображения" in result.stdout + result.stderr
+
+def test_cli_convert_rejects_truncated_image():
+    input_file = os.path.join(OUTPUT_DIR_FUNC, "truncated.jpg")
+    with open(os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg"), "rb") as src, open(input_file, "wb") as dst:
+        dst.write(src.read()[:2000])
+    output_file = os.path.join(OUTPUT_DIR_FUNC, "truncated.png")
+
+    result = run_script(["convert", input_file, output_file])
+
+    assert result.returncode != 0
+    assert "файл обрезан" in result.stderr
+    assert not os.path.exists(output_file)
+
+    # Без проверки файл уходит в конвертер, и ошибку сообщает уже он
+    result = run_script(["convert", input_file, output_file, "--no-probe"])
+    assert "файл обрезан" not in result.stderr
+
+def test_cli_convert_accepts_jpeg_with_large_trailing_data():
+    input_file = os.path.join(OUTPUT_DIR_FUNC, "motion_photo.jpg")
+    with open(os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg"), "rb") as src, open(input_file, "wb") as dst:
+        dst.write(src.read() + b"\x11" * 200 * 1024)
+    output_file = os.path.join(OUTPUT_DIR_FUNC, "motion_photo.png")
+
+    result = run_script(["convert", input_file, output_file])
+
+    assert result.returncode == 0, result.stderr
+    assert Image.open(output_file).format == "PNG"
+
 def test_cli_convert_missing_args():
     result = run_script(["convert", os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg")]) # Не хватает output
     assert result.returncode != 0 # Ожидаем ошибку от argparse
@@ -86,6 +193,48 @@ def test_cli_batch_convert_jpg_to_png(setup_batch_cli_dirs):
     assert os.path.exists(os.path.join(output_dir, "img1.png"))
     assert not os.path.exists(os.path.join(output_dir, "img2.png")) # т.к. входной формат был png
 
+def test_cli_batch_workers_writes_summary(setup_batch_cli_dirs):
+    input_dir, _ = setup_batch_cli_dirs
+    output_dir = os.path.join(OUTPUT_DIR_FUNC, "batch_output_cli_workers")
+    summary_file = os.path.join(OUTPUT_DIR_FUNC, "batch_summary.json")
+
+    result = run_script(["batch", input_dir, output_dir, "jpg", "png", "--workers", "2", "--summary", summary_file])
+
+    assert result.returncode == 0, f"Скрипт завершился с ошибкой: {result.stderr}"
+    assert os.path.exists(os.path.join(output_dir, "img1.png"))
+    with open(summary_file, encoding='utf-8') as f:
+        summary = json.load(f)
+    assert summary['processed'] == 1
+    assert summary['failed'] == 0
+
+def test_cli_batch_metrics_and_profile(setup_batch_cli_dirs):
+    input_dir, _ = setup_batch_cli_dirs
+    output_dir = os.path.join(OUTPUT_DIR_FUNC, "batch_output_cli_metrics")
+    prom_file = os.path.join(OUTPUT_DIR_FUNC, "batch_metrics.prom")
+    profile_file = os.path.join(OUTPUT_DIR_FUNC, "batch_tracemalloc.txt")
+
+    result = run_script(["--profile", "tracemalloc", "--profile-output", profile_file,
+                         "batch", input_dir, output_dir, "jpg", "png", "--metrics-prom", prom_file])
+
+    assert result.returncode == 0, f"Скрипт завершился с ошибкой: {result.stderr}"
+    with open(prom_file, encoding='utf-8') as f:
+        assert 'converter_files_total{format="jpg",status="ok"} 1' in f.read()
+    with open(profile_file, encoding='utf-8') as f:
+        assert "Пик выделенной памяти" in f.read()
+
+# --- Тесты для команды 'fanout' ---
+def test_cli_fanout_repeated_outputs():
+    input_file = os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg")
+    output_dir = os.path.join(OUTPUT_DIR_FUNC, "fanout")
+
+    result = run_script(["fanout", input_file, "--output-dir", output_dir,
+                         "-o", "{name}.png", "-o", "{name}.webp", "-o", "{name}_small.jpg:64"])
+
+    assert result.returncode == 0, f"Скрипт завершился с ошибкой: {result.stderr}"
+    assert "Создано вариантов: 3" in result.stdout
+    assert Image.open(os.path.join(output_dir, "sample.webp")).format == "WEBP"
+    assert max(Image.open(os.path.join(output_dir, "sample_small.jpg")).size) == 64
+
 # --- Тесты для команды 'pdf2img' ---
 @pytest.mark.skipif(not shutil.which("pdftoppm"), reason="Poppler (pdftoppm) не найден в PATH")
 def test_cli_pdf2img():
@@ -116,3 +265,144 @@ def test_cli_no_command():
     result = run_script([])
     assert result.returncode == 0 # Ожидаем код 0
     # Можно также проверить, что в stdout было приглашение интерактивного режима
+
+# --- Тесты для команд 'serve' и 'submit' ---
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix-сокеты не поддерживаются")
+def test_cli_serve_and_submit_over_unix_socket():
+    socket_dir = tempfile.mkdtemp() # Короткий путь: длина пути Unix-сокета ограничена
+    socket_path = os.path.join(socket_dir, "converter.sock")
+    server = subprocess.Popen([sys.executable, CONVERTER_SCRIPT, "serve", "--socket", socket_path, "--workers", "1"],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    try:
+        deadline = time.time() + 10
+        while not os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.05)
+        assert os.path.exists(socket_path), "Сервер не создал сокет"
+        assert os.stat(socket_path).st_mode & 0o777 == 0o600
+
+        output_file = os.path.join(OUTPUT_DIR_FUNC, "served.png")
+        result = run_script(["submit", os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg"), output_file,
+                             "--socket", socket_path])
+        assert result.returncode == 0, f"Скрипт завершился с ошибкой: {result.stderr}"
+        assert Image.open(output_file).format == "PNG"
+
+        result = run_script(["submit", os.path.join(TEST_DATA_DIR_FUNC, "non_existent.jpg"), output_file,
+                             "--socket", socket_path])
+        assert result.returncode != 0
+        assert "Ошибка при конвертации файла" in result.stderr
+
+        # Межсайтовый "простой" POST из браузера (text/plain) и запросы с Origin сервер не выполняет
+        body = json.dumps({"input": os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg"), "output": output_file})
+        for headers, status in (({"Content-Type": "text/plain"}, 415),
+                                ({"Content-Type": "application/json", "Origin": "http://evil.example"}, 403)):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(socket_path)
+            request = "POST /convert HTTP/1.0\r\nContent-Length: %d\r\n" % len(body.encode())
+            request += "".join(f"{key}: {value}\r\n" for key, value in headers.items()) + "\r\n" + body
+            client.sendall(request.encode())
+            response = b""
+            while chunk := client.recv(4096):
+                response += chunk
+            client.close()
+            assert response.split(b" ", 2)[1] == str(status).encode()
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="Unix-сокеты не поддерживаются")
+def test_cli_serve_defaults_to_private_unix_socket():
+    socket_dir = tempfile.mkdtemp()
+    env = dict(os.environ, XDG_RUNTIME_DIR=socket_dir)
+    socket_path = os.path.join(socket_dir, "converter.sock")
+    server = subprocess.Popen([sys.executable, CONVERTER_SCRIPT, "serve", "--workers", "1"], env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    try:
+        deadline = time.time() + 10
+        while not os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.05)
+        assert os.path.exists(socket_path), "Сервер без --port должен слушать Unix-сокет"
+        assert os.stat(socket_path).st_mode & 0o777 == 0o600
+
+        output_file = os.path.join(OUTPUT_DIR_FUNC, "served_default.png")
+        result = subprocess.run([sys.executable, CONVERTER_SCRIPT, "submit",
+                                 os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg"), output_file],
+                                env=env, capture_output=True, text=True)
+        assert result.returncode == 0, f"Скрипт завершился с ошибкой: {result.stderr}"
+        assert Image.open(output_file).format == "PNG"
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+def test_cli_submit_reports_unreachable_server():
+    listener = socket.socket() # Занимаем свободный порт и закрываем его, чтобы там гарантированно никого не было
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    result = run_script(["submit", os.path.join(TEST_DATA_DIR_FUNC, "sample.jpg"),
+                         os.path.join(OUTPUT_DIR_FUNC, "unreachable.png"), "--port", str(port)])
+    assert result.returncode == 1
+    assert "Ошибка: не удалось отправить задание серверу" in result.stderr
+
+# --- Тесты для команды 'bench' ---
+def test_cli_bench_writes_json_report():
+    report_file = os.path.join(OUTPUT_DIR_FUNC, "bench.json")
+
+    result = run_script(["bench", "--small-images", "2", "--large-images", "0", "--text-mb", "1",
+                         "--docx-files", "1", "--pdf-pages", "1", "--workers", "1", "--output", report_file])
+
+    assert result.returncode == 0, f"Скрипт завершился с ошибкой: {result.stderr}"
+    with open(report_file, encoding='utf-8') as f:
+        report = json.load(f)
+    for case in ("convert_image_small", "convert_text_copy", "convert_docx", "batch_convert"):
+        metrics = report['cases'][case]
+        assert metrics['files'] > 0
+        assert metrics['files_per_sec'] > 0
+        assert metrics['latency_p99'] >= metrics['latency_p50']
+    assert report['cases']['convert_image_small']['latency_per'] == 'file'
+    assert report['cases']['batch_convert']['latency_per'] == 'run'
+    assert "convert_image_large" not in report['cases']
+    assert report['startup']['import_ms'] > 0
+    assert report['startup']['help_seconds'] > 0
+    for profile in ("default", "fast", "balanced", "smallest"):
+        for metrics in report['encoders'][profile].values():
+            assert metrics['files'] == 2
+            assert metrics['bytes_out'] > 0
+            assert metrics['encode_seconds'] > 0
+
+def test_cli_bench_fails_when_import_exceeds_threshold():
+    result = run_script(["bench", "--small-images", "1", "--large-images", "0", "--text-mb", "1",
+                         "--docx-files", "1", "--pdf-pages", "1", "--workers", "1", "--max-import-ms", "0.001"])
+
+    assert result.returncode == 1
+    assert "Ошибка: холодный импорт занял" in result.stderr
+
+# --- Тесты времени запуска ---
+# Главная проверка — тяжелые модули не загружаются при импорте; время проверяется лишь с большим запасом,
+# так как оно зависит от машины
+def test_import_does_not_load_codec_libraries():
+    code = ("import sys, main; "
+            "print(','.join(m for m in ('PIL', 'PIL.Image', 'docx2txt', 'pdf2image', 'http.server', 'http.client') "
+            "if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(CONVERTER_SCRIPT),
+                            capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ""
+
+def test_import_time_within_generous_threshold():
+    # Порог задан с большим запасом относительно запуска пустого интерпретатора, чтобы не зависеть от
+    # машины; он ловит только грубые регрессии вроде возврата импорта кодеков на верхний уровень
+    def best_of(code, tries=5):
+        timings = []
+        for _ in range(tries):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(CONVERTER_SCRIPT), check=True)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    baseline = best_of("pass")
+    with_main = best_of("import main")
+
+    assert with_main - baseline < 1.0, f"import main: {with_main:.3f} с, python -c pass: {baseline:.3f} с"
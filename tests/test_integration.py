@@ -1,7 +1,13 @@
 import os
+import io
+import json
+import tarfile
+import time
 import shutil
 import pytest
-from main import batch_convert # Убедитесь, что импорт идет из вашего файла
+from PIL import Image
+import main
+from main import batch_convert, BatchMetrics, ConversionCache, fan_out_images, load_renditions, stream_convert, _run_jobs # Убедитесь, что импорт идет из вашего файла
 
 TEST_DATA_DIR_INTEGRATION = os.path.join(os.path.dirname(__file__), "test_data_integration")
 OUTPUT_DIR_INTEGRATION = os.path.join(os.path.dirname(__file__), "test_output_integration")
@@ -33,6 +39,28 @@ def setup_integration_dirs():
     # shutil.rmtree(TEST_DATA_DIR_INTEGRATION)
     # shutil.rmtree(OUTPUT_DIR_INTEGRATION)
 
+@pytest.fixture
+def broken_images(tmp_path):
+    """Директория с исправным good.jpg и поврежденным bad.jpg; у каждого теста своя копия."""
+    input_dir = tmp_path / "broken_images"
+    input_dir.mkdir()
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "img1.jpg"), input_dir / "good.jpg")
+    (input_dir / "bad.jpg").write_text("это не картинка", encoding="utf-8")
+    return str(input_dir)
+
+@pytest.fixture
+def tree_input(tmp_path):
+    """Дерево файлов разных форматов для тестов рекурсивного обхода и фильтров."""
+    input_dir = tmp_path / "tree_input"
+    base_test_data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+    (input_dir / "photos" / "2024").mkdir(parents=True)
+    (input_dir / "drafts").mkdir()
+    shutil.copy(os.path.join(base_test_data_dir, "sample.jpg"), input_dir / "photos" / "2024" / "UPPER.JPG")
+    shutil.copy(os.path.join(base_test_data_dir, "sample.docx"), input_dir / "contract.docx")
+    shutil.copy(os.path.join(base_test_data_dir, "sample.jpg"), input_dir / "drafts" / "skip.jpg")
+    shutil.copy(os.path.join(base_test_data_dir, "sample.txt"), input_dir / "notes.txt")
+    return str(input_dir)
+
 def test_batch_convert_jpg_to_png():
     input_dir = TEST_DATA_DIR_INTEGRATION
     output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, "jpg_to_png")
@@ -77,4 +105,440 @@ def test_batch_convert_non_existent_input_dir(capsys):
     # просто цикл for filename in os.listdir(input_dir): не выполнится
     # и output_dir может быть создан пустым.
     assert os.path.exists(output_dir) # output_dir создается в любом случае
-    assert len(os.listdir(output_dir)) == 0 # Должен быть пуст
\ No newline at end of file
+    assert len(os.listdir(output_dir)) == 0 # Должен быть пуст
+
+def test_batch_convert_parallel_workers_summary():
+    input_dir = TEST_DATA_DIR_INTEGRATION
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, "parallel_txt")
+    summary = batch_convert(input_dir, output_dir, "txt", "txt", workers=2)
+
+    assert summary['found'] == 1
+    assert summary['processed'] == 1
+    assert summary['failed'] == 0
+    assert os.path.exists(os.path.join(output_dir, "doc1.txt"))
+
+def test_batch_convert_counts_failed_files(broken_images, tmp_path):
+    input_dir = broken_images
+    output_dir = str(tmp_path / "output")
+
+    summary = batch_convert(input_dir, output_dir, "jpg", "png", workers=2)
+
+    assert summary['found'] == 2
+    assert summary['processed'] == 1
+    assert summary['failed'] == 1
+    assert summary['failed_files'] == [os.path.join(input_dir, "bad.jpg")]
+
+def test_batch_convert_incremental_skips_unchanged():
+    input_dir = os.path.join(TEST_DATA_DIR_INTEGRATION, "incremental_input")
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, "incremental_output")
+    os.makedirs(input_dir, exist_ok=True)
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "doc1.txt"), os.path.join(input_dir, "a.txt"))
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "doc1.txt"), os.path.join(input_dir, "b.txt"))
+
+    first = batch_convert(input_dir, output_dir, "txt", "txt", incremental=True)
+    assert first['processed'] == 2
+    assert first['skipped'] == 0
+
+    second = batch_convert(input_dir, output_dir, "txt", "txt", incremental=True)
+    assert second['processed'] == 0
+    assert second['skipped'] == 2
+
+    # Меняем содержимое одного файла — перекодироваться должен только он
+    with open(os.path.join(input_dir, "b.txt"), "a", encoding="utf-8") as f:
+        f.write("новая строка\n")
+    third = batch_convert(input_dir, output_dir, "txt", "txt", incremental=True)
+    assert third['processed'] == 1
+    assert third['skipped'] == 1
+    with open(os.path.join(output_dir, "b.txt"), encoding="utf-8") as f:
+        assert f.read().endswith("новая строка\n")
+
+def test_batch_convert_incremental_reconverts_on_param_change():
+    input_dir = os.path.join(TEST_DATA_DIR_INTEGRATION, "incremental_params_input")
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, "incremental_params_output")
+    os.makedirs(input_dir, exist_ok=True)
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "img1.jpg"), os.path.join(input_dir, "img.jpg"))
+
+    assert batch_convert(input_dir, output_dir, "jpg", "png", incremental=True)['processed'] == 1
+    assert batch_convert(input_dir, output_dir, "jpg", "bmp", incremental=True)['processed'] == 1
+    assert batch_convert(input_dir, output_dir, "jpg", "bmp", incremental=True)['skipped'] == 1
+
+def test_batch_convert_io_pipeline():
+    input_dir = TEST_DATA_DIR_INTEGRATION
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, "pipeline_jpg_to_png")
+    summary = batch_convert(input_dir, output_dir, "jpg", "png", workers=2, io_threads=2, max_size=8)
+
+    assert summary['processed'] == 1
+    assert summary['failed'] == 0
+    img = Image.open(os.path.join(output_dir, "img1.png"))
+    assert img.format == "PNG"
+    assert max(img.size) <= 8
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch_convert_io_pipeline_streams_text_and_docx(workers, tmp_path, monkeypatch, capsys):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "doc1.txt"), input_dir / "doc1.txt")
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "report.docx"), input_dir / "report.docx")
+    (input_dir / "broken.docx").write_text("это не docx", encoding="utf-8")
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "img1.jpg"), input_dir / "img1.jpg")
+    read_bytes = main._read_bytes
+
+    def read_images_only(path):
+        assert path.endswith(".jpg"), f"{path} прочитан в память целиком"
+        return read_bytes(path)
+    monkeypatch.setattr(main, "_read_bytes", read_images_only)
+
+    summary = batch_convert(str(input_dir), str(tmp_path / "output"), "txt,docx,jpg", "txt,txt,png",
+                            workers=workers, io_threads=2)
+
+    assert (summary['processed'], summary['failed']) == (3, 1)
+    assert summary['failed_files'] == [str(input_dir / "broken.docx")]
+    assert "Test DOCX content" in (tmp_path / "output" / "report.txt").read_text(encoding="utf-8")
+    out = capsys.readouterr().out
+    assert out.count("успешно сконвертирован в") == 3 # Сообщение печатается один раз на файл
+    assert "Ошибка при конвертации файла" in out
+
+@pytest.mark.parametrize("io_threads", [0, 2])
+def test_batch_convert_encoder_profile_and_options(io_threads):
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, f"encoder_profile_{io_threads}")
+    summary = batch_convert(TEST_DATA_DIR_INTEGRATION, output_dir, "png", "jpg", io_threads=io_threads,
+                            encoder_profile="smallest", encoder_options={"quality": 60})
+
+    assert summary['processed'] == 1
+    assert Image.open(os.path.join(output_dir, "img2.jpg")).info.get("progressive")
+
+def test_batch_convert_unknown_encoder_profile():
+    summary = batch_convert(TEST_DATA_DIR_INTEGRATION, os.path.join(OUTPUT_DIR_INTEGRATION, "encoder_unknown"),
+                            "jpg", "png", encoder_profile="tiny")
+
+    assert "Неизвестный профиль кодирования" in summary['error']
+    assert summary['processed'] == 0
+
+def test_batch_convert_io_pipeline_reports_failures(broken_images, tmp_path):
+    input_dir = broken_images
+    output_dir = str(tmp_path / "output")
+    summary = batch_convert(input_dir, output_dir, "jpg", "png", io_threads=2)
+
+    assert summary['processed'] == 1
+    assert summary['failed'] == 1
+    assert not os.path.exists(os.path.join(output_dir, "bad.png"))
+
+def test_batch_convert_metrics_jsonl_and_prometheus(broken_images, tmp_path):
+    input_dir = broken_images
+    output_dir = str(tmp_path / "output")
+    jsonl_path = str(tmp_path / "metrics.jsonl")
+    prom_path = str(tmp_path / "metrics.prom")
+    metrics = BatchMetrics(jsonl_path)
+    summary = batch_convert(input_dir, output_dir, "jpg", "png", metrics=metrics)
+    metrics.close()
+    metrics.write_prometheus(prom_path)
+
+    assert summary['metrics']['failed_by_format'] == {'jpg': 1}
+    assert summary['metrics']['bytes_out'] > 0
+    assert {'open', 'decode', 'encode', 'write'} <= set(summary['metrics']['stage_seconds'])
+    with open(jsonl_path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(record['ok'] for record in records) == [False, True]
+    assert all(record['error'] for record in records if not record['ok'])
+    with open(prom_path, encoding='utf-8') as f:
+        prom = f.read()
+    assert 'converter_files_total{format="jpg",status="ok"} 1' in prom
+    assert 'converter_files_total{format="jpg",status="failed"} 1' in prom
+
+def test_batch_convert_recursive_multi_format_with_filters(tree_input, tmp_path):
+    input_dir = tree_input
+    output_dir = str(tmp_path / "output")
+
+    summary = batch_convert(input_dir, output_dir, "jpg,docx", "png,txt", recursive=True, exclude=["drafts"])
+
+    assert summary['found'] == 2
+    assert summary['processed'] == 2
+    assert os.path.exists(os.path.join(output_dir, "photos", "2024", "UPPER.png"))
+    assert os.path.exists(os.path.join(output_dir, "contract.txt"))
+    assert not os.path.exists(os.path.join(output_dir, "drafts"))
+    assert not os.path.exists(os.path.join(output_dir, "notes.txt"))
+
+def test_batch_convert_include_filter_without_recursion(tree_input, tmp_path):
+    input_dir = tree_input
+    output_dir = str(tmp_path / "output")
+
+    summary = batch_convert(input_dir, output_dir, "docx,txt", "txt", include=["*.docx"])
+
+    assert summary['found'] == 1
+    assert os.listdir(output_dir) == ["contract.txt"]
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="Символические ссылки не поддерживаются")
+def test_batch_convert_recursive_survives_symlink_loop(tmp_path):
+    input_dir = tmp_path / "input"
+    (input_dir / "sub").mkdir(parents=True)
+    shutil.copy(os.path.join(os.path.dirname(__file__), "test_data", "sample.jpg"), input_dir / "sub" / "a.jpg")
+    os.symlink("..", input_dir / "sub" / "loop") # Петля: sub/loop -> input
+
+    summary = batch_convert(str(input_dir), str(tmp_path / "output"), "jpg", "png", recursive=True)
+
+    assert (summary['found'], summary['processed'], summary['failed']) == (1, 1, 0)
+    assert os.path.exists(tmp_path / "output" / "sub" / "a.png")
+
+def test_batch_convert_mismatched_format_lists():
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, "mismatched_formats")
+    summary = batch_convert(TEST_DATA_DIR_INTEGRATION, output_dir, "jpg,png,docx", "png,txt")
+    assert summary['error']
+    assert summary['found'] == 0
+
+def test_batch_convert_png_to_jpg_extension():
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, "png_to_jpg")
+    summary = batch_convert(TEST_DATA_DIR_INTEGRATION, output_dir, "png", "jpg")
+
+    assert summary['processed'] == 1
+    assert Image.open(os.path.join(output_dir, "img2.jpg")).format == "JPEG"
+
+@pytest.mark.parametrize("workers, io_threads", [(2, 0), (1, 2)])
+def test_batch_convert_cache_converts_duplicates_once(workers, io_threads):
+    input_dir = os.path.join(TEST_DATA_DIR_INTEGRATION, "duplicates")
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, f"duplicates_output_{workers}_{io_threads}")
+    cache = ConversionCache(os.path.join(OUTPUT_DIR_INTEGRATION, f"cache_{workers}_{io_threads}"))
+    os.makedirs(input_dir, exist_ok=True)
+    base_test_data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+    for name in ("logo_a.jpg", "logo_b.jpg", "logo_c.jpg"):
+        shutil.copy(os.path.join(base_test_data_dir, "sample.jpg"), os.path.join(input_dir, name))
+
+    first = batch_convert(input_dir, output_dir, "jpg", "png", workers=workers, io_threads=io_threads, cache=cache)
+    second = batch_convert(input_dir, output_dir, "jpg", "png", workers=workers, io_threads=io_threads, cache=cache)
+
+    assert first['processed'] == second['processed'] == 3
+    assert second['metrics']['cache_hits'] == 3
+    assert Image.open(os.path.join(output_dir, "logo_c.png")).format == "PNG"
+
+@pytest.mark.parametrize("workers, io_threads", [(1, 0), (2, 2)])
+def test_batch_convert_dedupe_converts_identical_inputs_once(workers, io_threads, capsys):
+    input_dir = os.path.join(TEST_DATA_DIR_INTEGRATION, f"dedupe_{workers}_{io_threads}")
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, f"dedupe_output_{workers}_{io_threads}")
+    os.makedirs(os.path.join(input_dir, "sub"), exist_ok=True)
+    base_test_data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+    for name in ("a.jpg", "b.jpg", os.path.join("sub", "c.jpg")):
+        shutil.copy(os.path.join(base_test_data_dir, "sample.jpg"), os.path.join(input_dir, name))
+    Image.new("RGB", (8, 8), "red").save(os.path.join(input_dir, "unique.jpg"))
+
+    summary = batch_convert(input_dir, output_dir, "jpg", "png", workers=workers, io_threads=io_threads,
+                            recursive=True, dedupe=True)
+
+    assert (summary['processed'], summary['failed'], summary['deduplicated']) == (4, 0, 2)
+    assert summary['metrics']['deduplicated'] == 2
+    assert summary['saved_seconds'] > 0
+    outputs = [os.path.join(output_dir, name) for name in ("a.png", "b.png", os.path.join("sub", "c.png"))]
+    with open(outputs[0], "rb") as f:
+        expected = f.read()
+    for path in outputs[1:]:
+        with open(path, "rb") as f:
+            assert f.read() == expected
+    assert "Дубликатов: 2." in capsys.readouterr().out
+
+def test_batch_convert_dedupe_survives_unreadable_file(tmp_path, monkeypatch):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "img1.jpg"), input_dir / name)
+    file_sha256 = main._file_sha256
+
+    def unreadable_b(path, *args):
+        if os.path.basename(path) == "b.jpg":
+            raise PermissionError(13, "Permission denied", path)
+        return file_sha256(path, *args)
+    monkeypatch.setattr(main, "_file_sha256", unreadable_b)
+
+    summary = batch_convert(str(input_dir), str(tmp_path / "output"), "jpg", "png", dedupe=True)
+
+    # b.jpg не хешируется и конвертируется сам по себе, а не обрывает пакет
+    assert summary['error'] is None
+    assert (summary['processed'], summary['failed'], summary['deduplicated']) == (3, 0, 1)
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch_convert_probe_routes_by_content_and_rejects_early(workers, capsys):
+    input_dir = os.path.join(TEST_DATA_DIR_INTEGRATION, "probe_input")
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, f"probe_output_{workers}")
+    os.makedirs(input_dir, exist_ok=True)
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "report.docx"), os.path.join(input_dir, "notes.txt"))
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "doc1.txt"), os.path.join(input_dir, "plain.txt"))
+    with open(os.path.join(TEST_DATA_DIR_INTEGRATION, "img1.jpg"), "rb") as src, \
+            open(os.path.join(input_dir, "cut.txt"), "wb") as dst:
+        dst.write(src.read()[:2000]) # Обрезанный JPEG с чужим расширением
+
+    summary = batch_convert(input_dir, output_dir, "txt", "txt", workers=workers, probe=True, retries=2,
+                            retry_backoff=0)
+
+    assert (summary['processed'], summary['failed']) == (2, 1)
+    assert summary['failed_files'] == [os.path.join(input_dir, "cut.txt")]
+    with open(os.path.join(output_dir, "notes.txt"), encoding="utf-8") as f:
+        assert "Test DOCX content" in f.read()
+    out = capsys.readouterr().out
+    assert "отклонен до конвертации: файл обрезан" in out
+    assert "Повтор" not in out # Отклоненные файлы не повторяются
+
+def test_batch_convert_probe_keeps_text_starting_with_bmp_signature(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "report.txt").write_text("BMW quarterly report\n", encoding="utf-8")
+
+    summary = batch_convert(str(input_dir), str(tmp_path / "output"), "txt", "txt", probe=True)
+
+    assert (summary['processed'], summary['failed']) == (1, 0)
+    assert (tmp_path / "output" / "report.txt").read_text(encoding="utf-8") == "BMW quarterly report\n"
+
+def test_batch_convert_probe_rejects_misnamed_file_for_other_converter(tmp_path, capsys):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "img2.png"), input_dir / "picture.txt")
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "report.docx"), input_dir / "notes.txt")
+
+    summary = batch_convert(str(input_dir), str(tmp_path / "output"), "txt", "txt", probe=True)
+
+    # PNG под именем .txt не пишется картинкой в picture.txt, а docx под именем .txt дает текст
+    assert (summary['processed'], summary['failed']) == (1, 1)
+    assert summary['failed_files'] == [str(input_dir / "picture.txt")]
+    assert not (tmp_path / "output" / "picture.txt").exists()
+    assert "Test DOCX content" in (tmp_path / "output" / "notes.txt").read_text(encoding="utf-8")
+    assert "нельзя сконвертировать в 'txt'" in capsys.readouterr().out
+
+def test_batch_convert_probe_accepts_format_aliases_silently(tmp_path, capsys):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "img1.jpg"), input_dir / "photo.jpeg")
+
+    summary = batch_convert(str(input_dir), str(tmp_path / "output"), "jpeg", "png", probe=True)
+
+    assert (summary['processed'], summary['failed']) == (1, 0)
+    assert "по содержимому" not in capsys.readouterr().out # .jpeg — то же, что 'jpg' по сигнатуре
+
+def test_fan_out_images_from_directory_with_json_spec():
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, "fan_out")
+    spec_path = os.path.join(OUTPUT_DIR_INTEGRATION, "renditions.json")
+    with open(spec_path, "w", encoding="utf-8") as f:
+        json.dump({"renditions": [{"output": "{stem}.png"},
+                                  {"output": "thumbs/{stem}.jpg", "format": "JPEG", "max_size": 32}]}, f)
+
+    summary = fan_out_images([TEST_DATA_DIR_INTEGRATION], load_renditions(spec_path), output_dir, workers=2)
+
+    assert summary['found'] == summary['processed'] == 2 # img1.jpg и img2.png
+    assert summary['outputs'] == 4
+    assert max(Image.open(os.path.join(output_dir, "thumbs", "img1.jpg")).size) == 32
+    assert Image.open(os.path.join(output_dir, "img2.png")).format == "PNG"
+
+def test_fan_out_images_requires_stem_for_several_inputs():
+    summary = fan_out_images([TEST_DATA_DIR_INTEGRATION], [{"output": "same.png"}],
+                             os.path.join(OUTPUT_DIR_INTEGRATION, "fan_out_clash"))
+    assert summary['error']
+    assert summary['processed'] == 0
+
+def _sleep_interval(delay):
+    """Задание для пула: возвращает интервал (начало, конец) своего выполнения."""
+    started = time.monotonic()
+    time.sleep(delay)
+    return started, time.monotonic()
+
+def test_run_jobs_memory_budget_runs_oversized_job_alone():
+    costs = {(0.2,): 40, (0.21,): 40, (0.22,): 150, (0.23,): 40} # Третье задание дороже всего бюджета
+
+    results = list(_run_jobs(_sleep_interval, list(costs), workers=4, job_cost=costs.get, memory_budget=100))
+
+    assert all(error is None for _, _, error in results)
+    intervals = sorted(interval for _, interval, _ in results)
+    oversized = intervals[2]
+    # Задание сверх бюджета не пересекается ни с одним другим
+    assert all(end <= oversized[0] or start >= oversized[1] for start, end in intervals if (start, end) != oversized)
+    # Два первых (40 + 40 <= 100) выполнялись параллельно
+    assert intervals[1][0] < intervals[0][1]
+
+def test_batch_convert_memory_budget_serializes_large_files(capsys):
+    output_dir = os.path.join(OUTPUT_DIR_INTEGRATION, "memory_budget")
+    summary = batch_convert(TEST_DATA_DIR_INTEGRATION, output_dir, "jpg,png", "png", workers=2, memory_budget=1024)
+
+    assert summary['processed'] == 2
+    assert "будет сконвертирован отдельно" in capsys.readouterr().out
+
+def test_batch_convert_memory_budget_reuses_probed_headers(tmp_path, monkeypatch, capsys):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ("img1.jpg", "img2.png"):
+        shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, name), input_dir / name)
+    # Оценка памяти берет заголовок из предварительной проверки и не открывает изображение повторно
+    monkeypatch.setattr("main._image_memory", lambda *args: pytest.fail("заголовок прочитан повторно"))
+
+    summary = batch_convert(str(input_dir), str(tmp_path / "output"), "jpg,png", "png", workers=2,
+                            memory_budget=1024, probe=True)
+
+    assert summary['processed'] == 2
+    assert "будет сконвертирован отдельно" in capsys.readouterr().out
+
+@pytest.fixture
+def journal_input(broken_images):
+    """broken_images с еще двумя исправными файлами: a.jpg, b.jpg, c.jpg и поврежденный bad.jpg."""
+    os.rename(os.path.join(broken_images, "good.jpg"), os.path.join(broken_images, "a.jpg"))
+    for name in ("b.jpg", "c.jpg"):
+        shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "img1.jpg"), os.path.join(broken_images, name))
+    return broken_images
+
+def test_batch_convert_journal_resume_and_retry_failed(journal_input, tmp_path):
+    input_dir = journal_input
+    output_dir = str(tmp_path / "output")
+
+    first = batch_convert(input_dir, output_dir, "jpg", "png", journal=True)
+    assert (first['processed'], first['failed']) == (3, 1)
+
+    # Имитируем сбой: последняя пачка записей о c.jpg не дошла до диска
+    journal_path = os.path.join(output_dir, ".converter_journal.jsonl")
+    with open(journal_path, encoding="utf-8") as f:
+        lines = [line for line in f if '"c.jpg"' not in line]
+    with open(journal_path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+
+    resumed = batch_convert(input_dir, output_dir, "jpg", "png", resume=True)
+    assert (resumed['processed'], resumed['failed'], resumed['skipped']) == (1, 0, 3)
+
+    shutil.copy(os.path.join(TEST_DATA_DIR_INTEGRATION, "img1.jpg"), os.path.join(input_dir, "bad.jpg"))
+    retried = batch_convert(input_dir, output_dir, "jpg", "png", retry_failed=True, retries=2, retry_backoff=0)
+    assert (retried['processed'], retried['failed'], retried['skipped']) == (1, 0, 3)
+    with open(journal_path, encoding="utf-8") as f:
+        states = {record['input']: record for record in map(json.loads, f) if 'input' in record}
+    assert {record['state'] for record in states.values()} == {"done"}
+    assert states["bad.jpg"]['attempts'] == 1
+
+def test_batch_convert_retries_failed_files_with_backoff(broken_images, tmp_path, capsys):
+    input_dir = broken_images
+    output_dir = str(tmp_path / "output")
+
+    summary = batch_convert(input_dir, output_dir, "jpg", "png", retries=2, retry_backoff=0.01)
+
+    assert summary['failed_files'] == [os.path.join(input_dir, "bad.jpg")]
+    assert summary['metrics']['failed_by_format'] == {"jpg": 1} # Попытки не умножают счетчик ошибок
+    assert "Повтор 2 из 2" in capsys.readouterr().out
+
+def test_batch_convert_resume_rejects_different_parameters(journal_input, tmp_path):
+    input_dir = journal_input
+    output_dir = str(tmp_path / "output")
+    batch_convert(input_dir, output_dir, "jpg", "png", journal=True)
+
+    summary = batch_convert(input_dir, output_dir, "jpg", "bmp", resume=True)
+    assert summary['error']
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_stream_convert_tar_in_tar_out(workers):
+    source = io.BytesIO()
+    with tarfile.open(fileobj=source, mode="w:gz") as tar:
+        for name in ("img1.jpg", "img2.png", "doc1.txt", "other.log"):
+            tar.add(os.path.join(TEST_DATA_DIR_INTEGRATION, name), arcname=f"in/{name}")
+        broken = tarfile.TarInfo("in/broken.jpg")
+        broken.size = 4
+        tar.addfile(broken, io.BytesIO(b"oops"))
+    source.seek(0)
+    target = io.BytesIO()
+
+    summary = stream_convert(source, target, "jpg,png,txt", "png,jpg,txt", workers=workers, max_size=8)
+
+    assert (summary['found'], summary['processed'], summary['failed']) == (4, 3, 1)
+    assert summary['failed_files'] == ["in/broken.jpg"]
+    target.seek(0)
+    with tarfile.open(fileobj=target, mode="r:") as tar:
+        assert sorted(tar.getnames()) == ["in/doc1.txt", "in/img1.png", "in/img2.jpg"]
+        img = Image.open(tar.extractfile("in/img1.png"))
+        assert img.format == "PNG"
+        assert max(img.size) <= 8
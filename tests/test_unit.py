@@ -1,5 +1,7 @@
+import io
 import os
 import shutil
+import zipfile
 import pytest
 from PIL import Image
 from main import (
@@ -7,6 +9,16 @@ from main import (
     convert_text,
     convert_docx,
     convert_pdf_to_image,
+    convert_file,
+    get_converter,
+    ConversionError,
+    ConversionCache,
+    _image_memory,
+    _header_memory,
+    _estimate_job_memory,
+    _sniff_format,
+    _probe_file,
+    _encoder_options,
 )
 
 # Пути к тестовым данным
@@ -62,6 +74,177 @@ def test_convert_image_non_existent_input(capsys):
     assert "Ошибка при конвертации изображения" in captured.out # Проверяем вывод об ошибке
     assert not os.path.exists(output_path)
 
+def test_convert_image_max_size_downscales_large_jpeg():
+    input_path = os.path.join(OUTPUT_DIR, "large_source.jpg")
+    Image.new("RGB", (1600, 1000), (40, 120, 200)).save(input_path, "JPEG")
+    output_path = os.path.join(OUTPUT_DIR, "large_thumbnail.png")
+
+    assert convert_image(input_path, output_path, "PNG", max_size=200)
+
+    img = Image.open(output_path)
+    assert img.format == "PNG"
+    assert img.size == (200, 125)
+
+def test_convert_image_max_size_does_not_upscale():
+    output_path = os.path.join(OUTPUT_DIR, "not_upscaled.png")
+    original_size = Image.open(JPG_FILE).size
+
+    assert convert_image(JPG_FILE, output_path, "PNG", max_size=100000)
+
+    assert Image.open(output_path).size == original_size
+
+def test_convert_image_encoder_profile_and_options(capsys):
+    source = os.path.join(OUTPUT_DIR, "encoder_source.png")
+    Image.effect_noise((256, 256), 64).convert("RGB").save(source)
+    default_path = os.path.join(OUTPUT_DIR, "encoder_default.jpg")
+    smallest_path = os.path.join(OUTPUT_DIR, "encoder_smallest.jpg")
+    low_quality_path = os.path.join(OUTPUT_DIR, "encoder_low_quality.jpg")
+
+    assert convert_image(source, default_path, "JPEG")
+    assert convert_image(source, smallest_path, "JPEG", encoder_profile="smallest")
+    # Явные параметры дополняют профиль и имеют приоритет над ним
+    assert convert_image(source, low_quality_path, "JPEG", encoder_profile="smallest",
+                         encoder_options={"quality": 10, "progressive": False})
+
+    assert Image.open(smallest_path).info.get("progressive")
+    assert not Image.open(low_quality_path).info.get("progressive")
+    assert os.path.getsize(smallest_path) < os.path.getsize(default_path)
+    assert os.path.getsize(low_quality_path) < os.path.getsize(smallest_path)
+    assert not convert_image(source, os.path.join(OUTPUT_DIR, "encoder_unknown.jpg"), "JPEG", encoder_profile="tiny")
+    assert "Неизвестный профиль кодирования" in capsys.readouterr().out
+
+@pytest.mark.parametrize("pil_format", ["PNG", "JPEG", "WEBP"])
+def test_encoder_profiles_differ_and_trade_speed_for_size(pil_format):
+    profiles = [_encoder_options(pil_format, name) for name in ("fast", "balanced", "smallest")]
+    assert all(profiles) # Каждый профиль задает параметры для каждого формата
+    assert len({tuple(sorted(options.items())) for options in profiles}) == 3
+
+    with Image.open(JPG_FILE) as img:
+        img.load()
+    sizes = []
+    for options in profiles:
+        buffer = io.BytesIO()
+        img.save(buffer, pil_format, **options)
+        sizes.append(len(buffer.getvalue()))
+    fast, balanced, smallest = sizes
+    assert balanced < fast and smallest < fast
+    if pil_format != "JPEG": # Прогрессивный JPEG выигрывает только на больших изображениях
+        assert smallest <= balanced
+
+def test_image_fan_out_decodes_once_and_chains_resizes():
+    large = os.path.join(OUTPUT_DIR, "fan_out_source.jpg")
+    Image.new("RGB", (1200, 800), "orange").save(large)
+    renditions = [
+        {"output": os.path.join(OUTPUT_DIR, "fan_out_small.jpg"), "max_size": 120},
+        {"output": os.path.join(OUTPUT_DIR, "fan_out_full.png")},
+        {"output": os.path.join(OUTPUT_DIR, "fan_out_medium.webp"), "max_size": 600},
+    ]
+
+    result = get_converter("image").fan_out(large, renditions)
+
+    assert result.ok, result.error
+    assert len(result.output_paths) == 3
+    assert Image.open(renditions[0]["output"]).size == (120, 80)
+    assert Image.open(renditions[1]["output"]).size == (1200, 800)
+    medium = Image.open(renditions[2]["output"])
+    assert (medium.format, medium.size) == ("WEBP", (600, 400))
+
+def test_image_memory_estimate_from_header():
+    path = os.path.join(OUTPUT_DIR, "estimate.jpg")
+    Image.new("RGB", (4000, 2000)).save(path)
+
+    assert _image_memory(path) == 4000 * 2000 * 4 * 2
+    # С max_size JPEG декодируется в draft-режиме в уменьшенном масштабе
+    assert _image_memory(path, max_size=256) == 1000 * 500 * 4 * 2
+    assert _estimate_job_memory(os.path.join(TEST_DATA_DIR, "non_existent.png"), "png") == 0
+
+def test_probe_file_returns_header_for_memory_estimate():
+    path = os.path.join(OUTPUT_DIR, "probe_estimate.jpg")
+    Image.new("RGB", (4000, 2000)).save(path)
+
+    fmt, reason, header = _probe_file(path, "jpg")
+
+    assert (fmt, reason) == ("jpg", None)
+    assert _header_memory(header) == _image_memory(path)
+    assert _header_memory(header, max_size=256) == _image_memory(path, max_size=256)
+
+@pytest.mark.parametrize("path, expected", [(JPG_FILE, "jpg"), (PNG_FILE, "jpg"), (DOCX_FILE, "docx"),
+                                            (PDF_FILE, "pdf"), (TXT_FILE, "txt")])
+def test_sniff_format_by_magic_bytes(path, expected):
+    # sample.png на самом деле JPEG: формат определяется по содержимому, а не по расширению
+    with open(path, "rb") as f:
+        assert _sniff_format(f.read(16)) == expected
+
+def test_sniff_format_png_and_unknown_binary():
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(buffer, "PNG")
+    assert _sniff_format(buffer.getvalue()[:16]) == "png"
+    assert _sniff_format(b"\x00\x01\x02\x03 not a known format") is None
+
+def test_sniff_format_checks_full_bmp_header():
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(buffer, "BMP")
+    data = buffer.getvalue()
+    assert _sniff_format(data[:18]) == "bmp"
+    assert _sniff_format(data[:18], len(data)) == "bmp"
+    assert _sniff_format(data[:18], len(data) + 1) is None # Поле размера не совпадает с размером файла
+    assert _sniff_format(b"BMW quarterly report") == "txt"
+
+def test_probe_file_routes_by_content_and_rejects_corrupt_files():
+    misnamed = os.path.join(OUTPUT_DIR, "probe_misnamed.txt")
+    shutil.copy(DOCX_FILE, misnamed)
+    truncated = os.path.join(OUTPUT_DIR, "probe_truncated.jpg")
+    with open(JPG_FILE, "rb") as src, open(truncated, "wb") as dst:
+        dst.write(src.read()[:2000])
+    not_image = os.path.join(OUTPUT_DIR, "probe_not_image.jpg")
+    with open(not_image, "w") as f:
+        f.write("это не картинка")
+
+    assert _probe_file(PNG_FILE, "png")[:2] == ("jpg", None)
+    assert _probe_file(misnamed, "txt") == ("docx", None, None)
+    assert _probe_file(TXT_FILE, "txt") == ("txt", None, None)
+    fmt, reason, _ = _probe_file(truncated, "jpg")
+    assert fmt == "jpg" and "обрезан" in reason
+    fmt, reason, _ = _probe_file(not_image, "jpg")
+    assert fmt == "jpg" and "cannot identify image file" in reason
+
+def test_probe_file_requires_gif_trailer_at_the_end():
+    buffer = io.BytesIO()
+    Image.effect_noise((64, 64), 64).convert("RGB").save(buffer, "GIF")
+    data = buffer.getvalue()
+    padded = os.path.join(OUTPUT_DIR, "probe_padded.gif")
+    with open(padded, "wb") as f:
+        f.write(data + b"\x00" * 16) # Дополнение нулями допустимо
+    trailing = os.path.join(OUTPUT_DIR, "probe_trailing.gif")
+    with open(trailing, "wb") as f:
+        f.write(data + b"\x01" * 1024) # Данные после трейлера: файл целый, решает полное декодирование
+    truncated = os.path.join(OUTPUT_DIR, "probe_truncated.gif")
+    with open(truncated, "wb") as f:
+        f.write(data[:len(data) // 2] + b"\x3b\x01") # Байт 0x3b есть в хвосте, но не последним
+
+    assert _probe_file(padded, "gif")[:2] == ("gif", None)
+    assert _probe_file(trailing, "gif")[:2] == ("gif", None)
+    fmt, reason, _ = _probe_file(truncated, "gif")
+    assert fmt == "gif" and "нет завершающего байта GIF" in reason
+
+def test_probe_file_accepts_jpeg_with_large_trailing_data():
+    # «Живое фото»: после EOI записано видео, маркера конца в последних PROBE_TAIL_BYTES нет
+    path = os.path.join(OUTPUT_DIR, "probe_motion_photo.jpg")
+    with open(JPG_FILE, "rb") as src, open(path, "wb") as dst:
+        dst.write(src.read() + b"\x11" * 200 * 1024)
+
+    assert _probe_file(path, "jpg")[:2] == ("jpg", None)
+
+def test_probe_file_falls_back_to_extension_when_bmp_header_does_not_open():
+    # Поля заголовка BMP совпадают, но данные не BMP: решает расширение
+    path = os.path.join(OUTPUT_DIR, "probe_fake_bmp.txt")
+    header = b"BM" + (40).to_bytes(4, "little") + b"\x00" * 8 + (40).to_bytes(4, "little")
+    with open(path, "wb") as f:
+        f.write(header + b"\xff" * 22)
+
+    assert _probe_file(path, "txt") == ("txt", None, None)
+    fmt, reason, _ = _probe_file(path, "bmp")
+    assert fmt == "bmp" and reason
 
 # --- Тесты для convert_text ---
 def test_convert_text_successful():
@@ -83,6 +266,25 @@ def test_convert_text_non_existent_input(capsys):
     assert "Ошибка при конвертации текстового файла" in captured.out
     assert not os.path.exists(output_path)
 
+def test_convert_text_transcodes_and_normalizes_newlines():
+    input_path = os.path.join(OUTPUT_DIR, "cp1251_crlf.txt")
+    output_path = os.path.join(OUTPUT_DIR, "cp1251_crlf_converted.txt")
+    with open(input_path, 'wb') as f:
+        f.write("Привет, мир\r\nвторая строка\r\n".encode('cp1251'))
+
+    assert convert_text(input_path, output_path, "txt", encoding='cp1251', newline='lf')
+
+    with open(output_path, 'rb') as f:
+        assert f.read() == "Привет, мир\nвторая строка\n".encode('utf-8')
+
+def test_convert_text_auto_encoding_keeps_bytes_for_utf8():
+    output_path = os.path.join(OUTPUT_DIR, "converted_auto.txt")
+
+    assert convert_text(TXT_FILE, output_path, "txt", encoding='auto')
+
+    with open(output_path, 'rb') as f, open(TXT_FILE, 'rb') as f_orig:
+        assert f.read() == f_orig.read()
+
 
 # --- Тесты для convert_docx ---
 def test_convert_docx_successful():
@@ -103,6 +305,43 @@ def test_convert_docx_non_existent_input(capsys):
     assert not os.path.exists(output_path)
 
 
+def _write_docx(path, body, header=None, image=None):
+    """Минимальный docx с заданным содержимым w:body, необязательным колонтитулом и изображением."""
+    ns = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("word/document.xml", f'<?xml version="1.0"?><w:document {ns}><w:body>{body}</w:body></w:document>')
+        if header:
+            zf.writestr("word/header1.xml", f'<?xml version="1.0"?><w:hdr {ns}>{header}</w:hdr>')
+        if image:
+            zf.write(image, "word/media/image1.png")
+
+def test_convert_docx_streams_tabs_breaks_and_headers():
+    input_path = os.path.join(OUTPUT_DIR, "structured.docx")
+    output_path = os.path.join(OUTPUT_DIR, "structured.txt")
+    _write_docx(input_path,
+                '<w:p><w:r><w:t xml:space="preserve">  Первый </w:t><w:tab/><w:t>абзац</w:t></w:r></w:p>'
+                '<w:tbl><w:tr><w:tc><w:p><w:r><w:t>ячейка</w:t><w:br/><w:t>&amp; строка</w:t></w:r></w:p></w:tc></w:tr></w:tbl>'
+                '<w:p/><w:p><w:r><w:t xml:space="preserve">конец  </w:t></w:r></w:p>',
+                header='<w:p><w:r><w:t>Шапка</w:t></w:r></w:p>', image=PNG_FILE)
+
+    assert convert_docx(input_path, output_path)
+
+    with open(output_path, encoding="utf-8") as f:
+        text = f.read()
+    assert text == "Шапка\n\n  Первый \tабзац\n\nячейка\n& строка\n\n\n\nконец"
+    docx2txt = pytest.importorskip("docx2txt")
+    assert text == docx2txt.process(input_path)
+
+def test_convert_docx_extracts_images_only_on_request():
+    input_path = os.path.join(OUTPUT_DIR, "with_image.docx")
+    images_dir = os.path.join(OUTPUT_DIR, "docx_images")
+    _write_docx(input_path, "<w:p><w:r><w:t>текст</w:t></w:r></w:p>", image=PNG_FILE)
+
+    assert convert_docx(input_path, os.path.join(OUTPUT_DIR, "with_image.txt"))
+    assert not os.path.exists(images_dir)
+    assert convert_docx(input_path, os.path.join(OUTPUT_DIR, "with_image.txt"), images_dir=images_dir)
+    assert os.listdir(images_dir) == ["image1.png"]
+
 # --- Тесты для convert_pdf_to_image ---
 # Эти тесты могут быть медленными и зависят от Poppler
 @pytest.mark.skipif(not shutil.which("pdftoppm"), reason="Poppler (pdftoppm) не найден в PATH")
@@ -138,4 +377,112 @@ def test_convert_pdf_to_image_non_existent_input(capsys):
     # Убедитесь, что ваша функция печатает что-то при FileNotFoundError,
     # либо измените проверку на ожидаемое исключение от pdf2image
     assert "Ошибка при конвертации PDF" in captured.out or "PDF файл не найден" in captured.out
-    assert not os.listdir(pdf_output_pages_dir if os.path.exists(pdf_output_pages_dir) else [])
\ No newline at end of file
+    assert not os.listdir(pdf_output_pages_dir if os.path.exists(pdf_output_pages_dir) else [])
+@pytest.mark.skipif(not shutil.which("pdftoppm"), reason="Poppler (pdftoppm) не найден в PATH")
+def test_convert_pdf_to_image_page_range_chunks():
+    pdf_output_pages_dir = os.path.join(OUTPUT_DIR, "pdf_pages_range")
+
+    assert convert_pdf_to_image(PDF_FILE, pdf_output_pages_dir, first_page=1, last_page=1, dpi=72, chunk_size=1, workers=2)
+
+    assert os.listdir(pdf_output_pages_dir) == ["page_1.jpg"]
+
+@pytest.mark.skipif(not shutil.which("pdftoppm"), reason="Poppler (pdftoppm) не найден в PATH")
+@pytest.mark.parametrize("output_format, expected", [("png", "PNG"), ("tiff", "TIFF"), ("webp", "WEBP")])
+def test_convert_pdf_to_image_output_formats(output_format, expected):
+    pdf_output_pages_dir = os.path.join(OUTPUT_DIR, f"pdf_pages_{output_format}")
+    assert convert_pdf_to_image(PDF_FILE, pdf_output_pages_dir, last_page=1, dpi=72, output_format=output_format,
+                                quality=80, grayscale=True)
+    page_path = os.path.join(pdf_output_pages_dir, f"page_1.{output_format}")
+    assert sorted(os.listdir(pdf_output_pages_dir)) == [f"page_1.{output_format}"] # Временных файлов pdftoppm не осталось
+    with Image.open(page_path) as img:
+        assert img.format == expected
+        if output_format != "webp": # WebP не хранит оттенки серого отдельным режимом
+            assert img.mode == "L"
+
+def test_convert_pdf_to_image_unknown_format(capsys):
+    pdf_output_pages_dir = os.path.join(OUTPUT_DIR, "pdf_pages_unknown_format")
+    assert not convert_pdf_to_image(PDF_FILE, pdf_output_pages_dir, output_format="bmp")
+    assert "Неподдерживаемый формат страниц PDF" in capsys.readouterr().out
+
+@pytest.mark.skipif(not shutil.which("pdftoppm"), reason="Poppler (pdftoppm) не найден в PATH")
+def test_convert_pdf_to_image_empty_range(capsys):
+    pdf_output_pages_dir = os.path.join(OUTPUT_DIR, "pdf_pages_empty_range")
+
+    assert not convert_pdf_to_image(PDF_FILE, pdf_output_pages_dir, first_page=100)
+
+    captured = capsys.readouterr()
+    assert "Пустой диапазон страниц" in captured.out
+    assert not os.listdir(pdf_output_pages_dir)
+
+
+# --- Тесты для библиотечного API ---
+def test_convert_file_returns_result():
+    output_path = os.path.join(OUTPUT_DIR, "api_converted.jpg")
+
+    result = convert_file(PNG_FILE, output_path)
+
+    assert result.ok
+    assert result.error is None
+    assert result.output_paths == [output_path]
+    assert result.bytes_in == os.path.getsize(PNG_FILE)
+    assert result.bytes_out == os.path.getsize(output_path)
+    assert set(result.stages) == {"open", "decode", "encode", "write"}
+    assert Image.open(output_path).format == "JPEG"
+
+def test_convert_file_failure_does_not_print(capsys):
+    input_path = os.path.join(TEST_DATA_DIR, "non_existent.docx")
+
+    result = convert_file(input_path, os.path.join(OUTPUT_DIR, "api_missing.txt"))
+
+    assert not result.ok
+    assert result.error
+    assert capsys.readouterr().out == ""
+    with pytest.raises(ConversionError):
+        result.raise_for_error()
+
+def test_convert_file_unsupported_format():
+    result = convert_file(os.path.join(TEST_DATA_DIR, "sample.xyz"), os.path.join(OUTPUT_DIR, "api.out"))
+    assert not result.ok
+    assert "Неподдерживаемый входной формат" in result.error
+
+def test_get_converter_reuses_instances():
+    assert get_converter("JPG") is get_converter("png") is get_converter("image")
+    assert get_converter(".docx") is get_converter("docx")
+    assert get_converter("xyz") is None
+
+# --- Тесты для ConversionCache ---
+def test_conversion_cache_hit_links_cached_output():
+    cache = ConversionCache(os.path.join(OUTPUT_DIR, "cache_hit"))
+    first = os.path.join(OUTPUT_DIR, "cache_first.png")
+    second = os.path.join(OUTPUT_DIR, "cache_second.png")
+
+    assert convert_file(JPG_FILE, first, cache=cache).cached is False
+    result = convert_file(JPG_FILE, second, cache=cache)
+
+    assert result.ok and result.cached
+    assert result.output_paths == [second]
+    assert "decode" not in result.stages
+    with open(first, "rb") as a, open(second, "rb") as b:
+        assert a.read() == b.read()
+    assert os.stat(second).st_nlink > 1
+    # Другие параметры — другой ключ
+    assert not convert_file(JPG_FILE, second, cache=cache, max_size=16).cached
+    assert os.stat(first).st_nlink > 1 # Перезапись second не затронула общую запись кэша
+
+def test_conversion_cache_evicts_least_recently_used():
+    sources = []
+    for i in range(3):
+        path = os.path.join(OUTPUT_DIR, f"cache_src_{i}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(str(i) * 1000)
+        sources.append(path)
+    cache = ConversionCache(os.path.join(OUTPUT_DIR, "cache_lru"), max_bytes=2500)
+
+    convert_file(sources[0], os.path.join(OUTPUT_DIR, "cache_out_0.txt"), cache=cache)
+    convert_file(sources[1], os.path.join(OUTPUT_DIR, "cache_out_1.txt"), cache=cache)
+    assert convert_file(sources[0], os.path.join(OUTPUT_DIR, "cache_out_0b.txt"), cache=cache).cached
+    convert_file(sources[2], os.path.join(OUTPUT_DIR, "cache_out_2.txt"), cache=cache)
+
+    assert cache.size() <= 2500
+    assert convert_file(sources[0], os.path.join(OUTPUT_DIR, "cache_out_0c.txt"), cache=cache).cached
+    assert not convert_file(sources[1], os.path.join(OUTPUT_DIR, "cache_out_1b.txt"), cache=cache).cached